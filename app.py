@@ -1,15 +1,24 @@
 # app.py
+import argparse
 import sys
 import os
 
 # Add the parent directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from tnkos.shell_widget import ShellApp
-
 def main():
+    parser = argparse.ArgumentParser(description="tnkos shell")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="report import time per module and time to first paint, then exit")
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        from tnkos.startup import profile_startup
+        return profile_startup()
+
+    from tnkos.shell_widget import ShellApp
     app = ShellApp()
     app.run()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
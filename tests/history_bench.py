@@ -0,0 +1,260 @@
+"""Per-keystroke latency benchmark for history search.
+
+Generates synthetic zsh histories, replays typing through
+search_command_history and HistoryView.update, and reports p50/p99 latency
+and peak memory per history size. Each size runs in its own process so peak
+RSS is not inherited from the previous one.
+
+The typing is replayed REPEATS times so p99 rests on 970 keys, not 97.
+Absolute timings vary between machines, and on a shared one from minute
+to minute, so the regression gate does not compare them directly: right
+before each replay a reference scan is timed (a plain-Python substring
+filter over the same commands, using no tnkos code), each key's latency
+is taken in units of it, and the gate compares the p99 of those with the
+baseline's.
+
+    python tests/history_bench.py                  # compare with the baseline
+    python tests/history_bench.py --save           # record a new baseline
+    python tests/history_bench.py --sizes 10000    # just one size
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+BASELINE_FILE = Path(__file__).with_name("history_bench_baseline.json")
+SIZES = [10_000, 100_000, 1_000_000]
+SEED = 1234
+REPEATS = 10
+
+# Queries typed one key at a time; "\b" is a backspace
+TYPING = [
+    "git checkout",
+    "gco",
+    "docker compose up",
+    "kubectl get pods -n",
+    "ssh prod",
+    "pytest -k",
+    "cd ~/src",
+    "vim conf\b\b\b\bsrc",
+    "make",
+    "xq",
+]
+
+GIT = ["status", "diff", "log --oneline", "pull", "push", "fetch --all", "add -p", "commit -m 'wip'",
+       "checkout main", "checkout -b feature/{word}", "rebase -i HEAD~{n}", "stash pop", "branch -D {word}",
+       "show {sha}", "cherry-pick {sha}", "revert --no-edit {sha}"]
+TOOLS = ["ls -la {path}", "cd {path}", "vim {path}/{word}.py", "cat {path}/{word}.txt", "rm -rf {path}/build",
+         "grep -rn {word} {path}", "find {path} -name '*.{ext}'", "python -m {word}", "pytest -k {word} -x",
+         "docker compose up -d {word}", "docker logs -f {word}", "kubectl get pods -n {word}",
+         "kubectl logs {word}-{n} -n prod", "ssh {host}", "scp {word}.tar.gz {host}:/tmp", "make {word}",
+         "curl -s https://{host}/api/{word} | jq .", "tar xzf {word}-{n}.tar.gz", "pip install {word}=={n}.{n}",
+         "npm run {word}", "echo ${word} > {path}/out.{ext}", "htop", "make", "clear",
+         "docker exec -it {sha} sh", "kill -9 {pid}", "less {path}/{word}-{pid}.{ext}"]
+WORDS = ["api", "auth", "billing", "cache", "core", "deploy", "docs", "events", "gateway", "infra", "jobs",
+         "metrics", "notify", "orders", "payments", "queue", "search", "session", "users", "worker"]
+PATHS = ["~/src", "~/src/tnkos", "/etc/nginx", "/var/log", "~/work/platform", "./build", "../shared", "/tmp"]
+HOSTS = ["prod-1", "prod-2", "staging", "bastion", "db.internal", "ci.example.com"]
+EXTS = ["py", "txt", "json", "yaml", "log", "md"]
+
+def synthetic_command(rng):
+    fill = {
+        "word": rng.choice(WORDS),
+        "path": rng.choice(PATHS),
+        "host": rng.choice(HOSTS),
+        "ext": rng.choice(EXTS),
+        "n": rng.randint(1, 40),
+        "sha": f"{rng.getrandbits(28):07x}",
+        "pid": rng.randint(300, 99999),
+    }
+    if rng.random() < 0.3:
+        return "git " + rng.choice(GIT).format(**fill)
+    return rng.choice(TOOLS).format(**fill)
+
+def write_history(path, lines, seed=SEED):
+    """A zsh EXTENDED_HISTORY file of lines entries, mostly reruns of earlier ones."""
+    rng = random.Random(seed)
+    recent = []
+    timestamp = 1_700_000_000
+    with open(path, "w") as file:
+        for _ in range(lines):
+            if recent and rng.random() < 0.6:
+                # Favour recently used commands, like real shells
+                command = recent[-1 - min(int(rng.expovariate(0.05)), len(recent) - 1)]
+            else:
+                command = synthetic_command(rng)
+                recent.append(command)
+            timestamp += rng.randint(1, 120)
+            file.write(f": {timestamp}:0;{command}\n")
+
+def keystrokes(text):
+    query = ""
+    for key in text:
+        query = query[:-1] if key == "\b" else query + key
+        yield query
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))]
+
+def summarize(samples, relative):
+    return {
+        "p50_ms": percentile(samples, 50),
+        "p99_ms": percentile(samples, 99),
+        "p99_relative": percentile(relative, 99),
+        "keys": len(samples),
+    }
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def replay_once(search):
+    """Ms per key of search over one pass of the typing."""
+    samples = []
+    for text in TYPING:
+        search("")
+        for query in keystrokes(text):
+            start = time.perf_counter()
+            search(query)
+            samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def reference_ms(commands):
+    """Ms per key of a substring scan over commands: how fast the machine is right now, not tnkos."""
+    def scan(query):
+        return [command for command in commands if query in command]
+    # The faster of two passes, the one less disturbed by whatever else runs
+    return min(sum(samples) / len(samples) for samples in (replay_once(scan), replay_once(scan)))
+
+def replay(search, commands, repeats=REPEATS):
+    """Summary of search over repeats passes of the typing, each against a reference timed just before it."""
+    samples = []
+    relative = []
+    for _ in range(repeats):
+        reference = reference_ms(commands)
+        passed = replay_once(search)
+        samples.extend(passed)
+        relative.extend(sample / reference for sample in passed)
+    return summarize(samples, relative)
+
+async def replay_view(app_cls, commands, repeats=REPEATS):
+    from tnkos.history import HistoryView
+    app = app_cls()
+    async with app.run_test(size=(120, 40)):
+        view = app.query_one(HistoryView)
+        return replay(view.update, commands, repeats)
+
+def run_size(lines, repeats=REPEATS):
+    from textual.app import App
+    from tnkos import history
+    from tnkos.history import HistoryStore, HistoryView
+
+    class BenchApp(App):
+        current_directory = os.getcwd()
+
+        def compose(self):
+            yield HistoryView()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shell_history = os.path.join(tmp, "zsh_history")
+        write_history(shell_history, lines)
+        history.history_store = HistoryStore(os.path.join(tmp, "tnkos_history"), shell_history)
+
+        start = time.perf_counter()
+        history.history_store.load()
+        load = time.perf_counter() - start
+        loaded_rss = peak_rss_mb()
+
+        commands = history.history_store.commands
+        search = replay(history.search_command_history, commands, repeats)
+        view = asyncio.run(replay_view(BenchApp, commands, repeats))
+
+    return {
+        "lines": lines,
+        "unique": len(history.history_store.commands),
+        "load_s": load,
+        "search": search,
+        "view": view,
+        "loaded_rss_mb": loaded_rss,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def run_isolated(lines, repeats=REPEATS):
+    output = subprocess.run([sys.executable, __file__, "--run", str(lines), "--repeats", str(repeats)],
+                            check=True, stdout=subprocess.PIPE, text=True)
+    return json.loads(output.stdout)
+
+def compare(result, baseline, tolerance):
+    """Lines describing result against baseline; False when p99 regressed past tolerance.
+
+    The gate is on p99 in units of the reference scan, so a slower or
+    busier machine moves both sides alike; the ms figures are for reading.
+    """
+    ok = True
+    lines = []
+    for key in ("search", "view"):
+        for stat in ("p50_ms", "p99_ms", "p99_relative"):
+            now, then = result[key][stat], baseline[key][stat]
+            ratio = now / then if then else float("inf")
+            flag = ""
+            if stat == "p99_relative" and ratio > tolerance:
+                ok = False
+                flag = "  REGRESSION"
+            lines.append(f"    {key} {stat}: {now:8.2f} vs {then:8.2f} ({ratio:.2f}x){flag}")
+    now, then = result["peak_rss_mb"], baseline["peak_rss_mb"]
+    lines.append(f"    peak_rss_mb: {now:8.1f} vs {then:8.1f} ({now / then:.2f}x)")
+    return ok, lines
+
+def report(result):
+    print(f"{result['lines']:>9} lines, {result['unique']} unique, loaded in {result['load_s']:.2f}s")
+    for key in ("search", "view"):
+        stats = result[key]
+        print(f"    {key:6} p50 {stats['p50_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms"
+              f"  p99 {stats['p99_relative']:.1f}x reference  ({stats['keys']} keys)")
+    print(f"    rss after load {result['loaded_rss_mb']:.1f} MiB, peak {result['peak_rss_mb']:.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="p99 slowdown over baseline, relative to the reference scan, that fails the run")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="times the typing is replayed per size")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        json.dump(run_size(args.run, args.repeats), sys.stdout)
+        return 0
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    results = {}
+    ok = True
+    for lines in args.sizes:
+        result = results[str(lines)] = run_isolated(lines, args.repeats)
+        report(result)
+        if not args.save and "p99_relative" in baseline.get(str(lines), {}).get("search", {}):
+            size_ok, lines_out = compare(result, baseline[str(lines)], args.tolerance)
+            ok = ok and size_ok
+            print("\n".join(lines_out))
+
+    if args.save:
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"saved baseline to {args.baseline}")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
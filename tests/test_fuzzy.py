@@ -0,0 +1,73 @@
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tnkos.fuzzy import Corpus, batch_candidates, fuzzymatch_batch, fuzzymatch_v2
+from tnkos.ngram import NgramIndex
+
+WORDS = ["git", "checkout", "commit", "docker", "compose", "ls", "-la", "cd", "~/src", "make", "FooBar",
+         "kubectl", "logs", "./build", "/etc/nginx", "a_b", "x1", "Ünïcödé", "café", "naïve", "日本"]
+PATTERNS = ["", "g", "gco", "git c", "dc", "ls-", "src", "FB", "fb", "x1", "caf", "ü", "n", "zzz", "/e", "ab"]
+
+def random_corpus(rng, size=400):
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6))) for _ in range(size)]
+
+def single(items, pattern):
+    results = [fuzzymatch_v2(False, False, True, item, pattern, False)[0] for item in items]
+    return tuple(np.array(column, dtype=np.int64) for column in zip(*results))
+
+def assert_same(batch, expected):
+    for got, want in zip(batch, expected):
+        np.testing.assert_array_equal(got, want)
+
+def test_batch_matches_single():
+    rng = random.Random(1)
+    items = random_corpus(rng)
+    corpus = Corpus(items)
+    for pattern in PATTERNS:
+        assert_same(fuzzymatch_batch(corpus, pattern), single(items, pattern))
+
+def test_batch_matches_single_on_candidates():
+    rng = random.Random(2)
+    items = random_corpus(rng)
+    corpus = Corpus(items)
+    candidates = np.array(sorted(rng.sample(range(len(items)), 150)))
+    for pattern in PATTERNS:
+        expected = single([items[i] for i in candidates], pattern)
+        assert_same(fuzzymatch_batch(corpus, pattern, candidates=candidates), expected)
+
+def test_ngram_candidates_keep_every_match():
+    rng = random.Random(3)
+    items = random_corpus(rng)
+    corpus = Corpus(items[:300])
+    index = NgramIndex(corpus)
+    for pattern in PATTERNS + ["ggg", "ooo", "xz"]:
+        index.candidates(pattern)
+    corpus.extend(items[300:])
+    index.extend()
+    for pattern in PATTERNS + ["ggg", "ooo", "xz"]:
+        candidates = index.candidates(pattern)
+        matches = batch_candidates(corpus, pattern)
+        if candidates is None:
+            continue
+        assert np.all(candidates[:-1] < candidates[1:])
+        assert set(matches.tolist()) <= set(candidates.tolist())
+        # Every candidate holds each pattern char often enough
+        for i in candidates.tolist():
+            folded = items[i].lower()
+            assert all(folded.count(char) >= pattern.count(char) for char in pattern)
+
+def test_regex_metacharacters_match_literally():
+    items = ["ls *.py", "echo (a)", "grep -E 'a+b?' [x]", "cd \\tmp", "plain"]
+    corpus = Corpus(items)
+    for pattern in ["*", "(", ")", "*.py", "+b?", "[x]", "\\", "|", "$", "^"]:
+        expected = single(items, pattern)
+        assert_same(fuzzymatch_batch(corpus, pattern), expected)
+        for item, sidx in zip(items, expected[0].tolist()):
+            assert (sidx >= 0) == all(char in item for char in pattern)
+    (sidx, eidx, _), positions = fuzzymatch_v2(False, False, True, "echo (a)", "(a", True)
+    assert positions == [5, 6]
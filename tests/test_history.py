@@ -0,0 +1,87 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tnkos.history import HistoryStore, HistoryWriter
+
+def use_count(store, command):
+    return store.frecency.counts[store.frecency.ids[command]]
+
+def test_compaction_keeps_use_counts(tmp_path):
+    history_file = tmp_path / "history"
+    writer = HistoryWriter(history_file, fsync_interval=None)
+    for _ in range(5):
+        writer.append("ls")
+    writer.append("pwd")
+
+    writer.compact()
+    writer.close()
+    store = HistoryStore(history_file, tmp_path / "shell_history")
+    store.load()
+    assert use_count(store, "ls") == 5
+    assert use_count(store, "pwd") == 1
+
+    # Runs after a compaction add to the ones it folded away
+    for _ in range(3):
+        writer.append("ls")
+    writer.compact()
+    writer.close()
+    store.load()
+    assert use_count(store, "ls") == 8
+    assert store.commands.count("ls") == 1
+
+def test_cwds_survive_a_restart(tmp_path):
+    history_file = tmp_path / "history"
+    writer = HistoryWriter(history_file, fsync_interval=None)
+    writer.append("make")
+    store = HistoryStore(history_file, tmp_path / "shell_history")
+    store.load()
+    store.record_cwd("make", "/src")
+
+    writer.close()
+    writer.save_cwds(store.cwds())
+    restarted = HistoryStore(history_file, tmp_path / "shell_history")
+    restarted.load()
+    assert restarted.cwds() == {"make": ["/src"]}
+
+def test_record_cwd_does_not_wait_for_the_lock(tmp_path):
+    history_file = tmp_path / "history"
+    writer = HistoryWriter(history_file, fsync_interval=None)
+    writer.append("make")
+    writer.close()
+    store = HistoryStore(history_file, tmp_path / "shell_history")
+    store.load()
+    recorded = threading.Event()
+    with store.lock:
+        # As if a search were running in a worker thread
+        threading.Thread(target=lambda: (store.record_cwd("make", "/src"), recorded.set())).start()
+        assert recorded.wait(1)
+    store.search("make")
+    assert store.cwds() == {"make": ["/src"]}
+
+def test_appends_follow_a_compaction_by_another_process(tmp_path):
+    history_file = tmp_path / "history"
+    first = HistoryWriter(history_file, fsync_interval=None)
+    second = HistoryWriter(history_file, fsync_interval=None)
+    first.append("one")
+    first.append("one")
+    second.compact()
+    first.append("two")
+    first.close()
+    second.close()
+    store = HistoryStore(history_file, tmp_path / "shell_history")
+    store.load()
+    assert store.commands == ["one", "two"]
+    assert use_count(store, "one") == 2
+
+def test_compaction_leaves_a_file_without_duplicates_alone(tmp_path):
+    history_file = tmp_path / "history"
+    writer = HistoryWriter(history_file, fsync_interval=None)
+    writer.append("one")
+    writer.append("two")
+    inode = os.stat(history_file).st_ino
+    writer.compact()
+    assert os.stat(history_file).st_ino == inode
+    writer.close()
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tnkos.sse import Delta, SSEDecoder, SSEEvent, anthropic_deltas, openai_deltas
+
+NEWLINES = [b"\n", b"\r\n", b"\r"]
+CHUNK_SIZES = [1, 2, 3, None]
+
+def openai_chunk(content=None, finish_reason=None, usage=None):
+    chunk = {"choices": [{"index": 0, "delta": {} if content is None else {"content": content},
+                          "finish_reason": finish_reason}]}
+    if usage is not None:
+        chunk["usage"] = {"completion_tokens": usage}
+    return json.dumps(chunk)
+
+OPENAI_EVENTS = [
+    SSEEvent("message", openai_chunk("Hel"), None),
+    SSEEvent("message", openai_chunk("loé"), None),
+    SSEEvent("message", openai_chunk(finish_reason="stop", usage=2), None),
+    SSEEvent("message", "[DONE]", None),
+]
+OPENAI_DELTAS = [
+    Delta("text", "Hel"), Delta("text", "loé"), Delta("stop", "stop"), Delta("usage", 2), Delta("done", None),
+]
+
+ANTHROPIC_EVENTS = [
+    SSEEvent("message_start", json.dumps({"type": "message_start", "message": {}}), None),
+    SSEEvent("ping", json.dumps({"type": "ping"}), None),
+    SSEEvent("content_block_delta", json.dumps({"type": "content_block_delta",
+                                                "delta": {"type": "text_delta", "text": "Hi"}}), None),
+    SSEEvent("message_delta", json.dumps({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                                          "usage": {"output_tokens": 1}}), None),
+    SSEEvent("message_stop", json.dumps({"type": "message_stop"}), None),
+]
+ANTHROPIC_DELTAS = [Delta("text", "Hi"), Delta("stop", "end_turn"), Delta("usage", 1), Delta("done", None)]
+
+def encode(events, newline, comments=True):
+    """The wire form of events, with a keep-alive comment before each when comments is set."""
+    out = b""
+    for event in events:
+        if comments:
+            out += b": keep-alive" + newline
+        if event.event != "message":
+            out += b"event: " + event.event.encode() + newline
+        out += b"data: " + event.data.encode() + newline + newline
+    return out
+
+def decode(stream, size):
+    decoder = SSEDecoder()
+    events = []
+    if size is None:
+        events.extend(decoder.feed(stream))
+    else:
+        for start in range(0, len(stream), size):
+            events.extend(decoder.feed(stream[start:start + size]))
+    event = decoder.flush()
+    if event is not None:
+        events.append(event)
+    return events
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("newline", NEWLINES)
+def test_openai_stream(newline, size):
+    events = decode(encode(OPENAI_EVENTS, newline), size)
+    assert events == OPENAI_EVENTS
+    assert [delta for event in events for delta in openai_deltas(event)] == OPENAI_DELTAS
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("newline", NEWLINES)
+def test_anthropic_stream(newline, size):
+    events = decode(encode(ANTHROPIC_EVENTS, newline), size)
+    assert events == ANTHROPIC_EVENTS
+    assert [delta for event in events for delta in anthropic_deltas(event)] == ANTHROPIC_DELTAS
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_fields_across_chunks(size):
+    # Mixed line ends, multi-line data, an id, no space after the colon and no blank line at the end
+    stream = b"id: 7\r\ndata: one\rdata:two\n\r\nevent: last\ndata: end"
+    assert decode(stream, size) == [SSEEvent("message", "one\ntwo", "7"), SSEEvent("last", "end", "7")]
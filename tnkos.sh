@@ -19,7 +19,5 @@ resolve_script_path() {
 # Get the directory of this script, resolving symlinks
 SCRIPT_DIR="$(resolve_script_path)"
 
-. "$SCRIPT_DIR/.venv/bin/activate"
-
-# Run the Python script
-python3 "$SCRIPT_DIR/app.py" "$@"
+# The venv's interpreter directly: sourcing activate costs a shell on every launch
+exec "$SCRIPT_DIR/.venv/bin/python3" "$SCRIPT_DIR/app.py" "$@"
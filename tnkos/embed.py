@@ -1,6 +1,6 @@
 import os
-import json
-import httpx
+
+from .http_pool import get_client
 
 class Embedder:
     EMBEDDING_MODEL = "embedding-model-name"
@@ -19,7 +19,7 @@ class Embedder:
             "input": input
         }
 
-        with httpx.Client() as client:
-            response = client.post(self.EMBED_API_URL + self.EMBED_ENDPOINT, headers=headers, json=data)
-            response.raise_for_status()
-            return response.json()
+        client = get_client(self.EMBED_API_URL)
+        response = client.post(self.EMBED_API_URL + self.EMBED_ENDPOINT, headers=headers, json=data)
+        response.raise_for_status()
+        return response.json()
@@ -0,0 +1,122 @@
+import json
+import os
+import time
+from array import array
+
+import numpy as np
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+MAX_CWDS = 4
+
+class Frecency:
+    """Use counts and recency per unique command, zoxide style.
+
+    Records are parallel arrays indexed by command id, ids handed out in
+    first-seen order. cwds holds the last few directories a command ran in,
+    as reported by record_cwd.
+    """
+
+    __slots__ = ("ids", "commands", "counts", "last_used", "last_seq", "cwds", "pending_cwds", "seq")
+
+    def __init__(self):
+        self.ids = {}
+        self.commands = []
+        self.counts = array("I")
+        self.last_used = array("d")
+        # Position in the history stream, for ordering uses without timestamps
+        self.last_seq = array("Q")
+        self.cwds = []
+        self.pending_cwds = {}
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, command, timestamp=0):
+        """Count one use of command; returns (id, is_new)."""
+        self.seq += 1
+        command_id = self.ids.get(command)
+        is_new = command_id is None
+        if is_new:
+            command_id = self.ids[command] = len(self.commands)
+            self.commands.append(command)
+            self.counts.append(1)
+            self.last_used.append(timestamp)
+            self.last_seq.append(self.seq)
+            self.cwds.append(None)
+        else:
+            self.counts[command_id] += 1
+            self.last_used[command_id] = max(self.last_used[command_id], timestamp)
+            self.last_seq[command_id] = self.seq
+        cwd = self.pending_cwds.pop(command, None)
+        if cwd is not None:
+            self._add_cwd(command_id, cwd)
+        return command_id, is_new
+
+    def add_uses(self, command, uses):
+        """Count uses of a known command that its history no longer lists; unknown commands are ignored."""
+        command_id = self.ids.get(command)
+        if command_id is not None:
+            self.counts[command_id] += uses
+
+    def record_cwd(self, command, cwd):
+        """Remember where command ran; applied now or when its use is added."""
+        command_id = self.ids.get(command)
+        if command_id is None:
+            self.pending_cwds[command] = cwd
+        else:
+            self._add_cwd(command_id, cwd)
+
+    def _add_cwd(self, command_id, cwd):
+        cwds = [d for d in self.cwds[command_id] or () if d != cwd]
+        self.cwds[command_id] = tuple([cwd] + cwds[:MAX_CWDS - 1])
+
+    def scores(self, ids, now=None, cwd=None):
+        """Frecency of each command id: use count weighted by how recently it was used."""
+        now = time.time() if now is None else now
+        counts = np.frombuffer(self.counts, dtype=np.uint32)[ids].astype(np.float64)
+        age = now - np.frombuffer(self.last_used, dtype=np.float64)[ids]
+        weight = np.select([age < HOUR, age < DAY, age < WEEK], [4.0, 2.0, 0.5], 0.25)
+        scores = counts * weight
+        if cwd is not None:
+            here = np.fromiter((bool(self.cwds[i]) and cwd in self.cwds[i] for i in ids.tolist()), dtype=bool, count=len(ids))
+            scores[here] *= 2
+        return scores
+
+    def recency(self, ids):
+        return np.frombuffer(self.last_seq, dtype=np.uint64)[ids]
+
+class FrecencyStore:
+    """What Frecency needs that the history file itself does not keep.
+
+    uses counts the runs of each command dropped by compacting the history,
+    which keeps only the last one; cwds maps commands to the directories
+    they last ran in, latest first. Stored as JSON; a missing or unreadable
+    file is an empty store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.uses = {}
+        self.cwds = {}
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+            self.uses = dict(data.get("uses", {}))
+            self.cwds = {command: list(cwds) for command, cwds in data.get("cwds", {}).items()}
+        except (OSError, ValueError, AttributeError):
+            self.uses = {}
+            self.cwds = {}
+        return self
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"uses": self.uses, "cwds": self.cwds}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
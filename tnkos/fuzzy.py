@@ -1,133 +1,363 @@
-import re
+import threading
 import unicodedata
 
+import numpy as np
+
+SCORE_MATCH = 16
+SCORE_GAP_START = -3
+SCORE_GAP_EXTENSION = -1
+
+BONUS_BOUNDARY = SCORE_MATCH // 2
+BONUS_NON_WORD = SCORE_MATCH // 2
+BONUS_CAMEL_123 = BONUS_BOUNDARY + SCORE_GAP_EXTENSION
+BONUS_CONSECUTIVE = -(SCORE_GAP_START + SCORE_GAP_EXTENSION)
+BONUS_FIRST_CHAR_MULTIPLIER = 2
+BONUS_BOUNDARY_WHITE = BONUS_BOUNDARY + 2
+BONUS_BOUNDARY_DELIMITER = BONUS_BOUNDARY + 1
+
+# Ordered like fzf so "class > CHAR_NON_WORD" means a word character
+CHAR_WHITE, CHAR_NON_WORD, CHAR_DELIMITER, CHAR_LOWER, CHAR_UPPER, CHAR_LETTER, CHAR_NUMBER = range(7)
+INITIAL_CHAR_CLASS = CHAR_WHITE
+DELIMITER_CHARS = '/,:;|'
+
+# Scratch space per thread; DPs that would not fit fall back to the greedy matcher
+SLAB_16_SIZE = 100 * 1024
+SLAB_32_SIZE = 2048
+
 def is_ascii(s):
-    return all(ord(c) < 128 for c in s)
+    return s.isascii()
 
 def normalize_rune(r):
     return unicodedata.normalize('NFKD', r)[0]
 
 def char_class_of(char):
     if char.islower():
-        return 'charLower'
+        return CHAR_LOWER
     elif char.isupper():
-        return 'charUpper'
-    elif char.isdigit():
-        return 'charNumber'
+        return CHAR_UPPER
+    elif char.isnumeric():
+        return CHAR_NUMBER
+    elif char.isalpha():
+        return CHAR_LETTER
     elif char.isspace():
-        return 'charWhite'
-    elif char in '/,:;|':
-        return 'charDelimiter'
+        return CHAR_WHITE
+    elif char in DELIMITER_CHARS:
+        return CHAR_DELIMITER
     else:
-        return 'charNonWord'
+        return CHAR_NON_WORD
 
 def bonus_for(prev_class, charclass):
-    if charclass > 'charNonWord':
-        if prev_class == 'charWhite':
-            return 10
-        elif prev_class == 'charDelimiter':
-            return 9
-        elif prev_class == 'charNonWord':
-            return 8
-    if (prev_class == 'charLower' and charclass == 'charUpper') or (prev_class != 'charNumber' and charclass == 'charNumber'):
-        return 7
-    if charclass in ['charNonWord', 'charDelimiter']:
-        return 6
-    elif charclass == 'charWhite':
-        return 10
+    if charclass > CHAR_NON_WORD:
+        if prev_class == CHAR_WHITE:
+            return BONUS_BOUNDARY_WHITE
+        elif prev_class == CHAR_DELIMITER:
+            return BONUS_BOUNDARY_DELIMITER
+        elif prev_class == CHAR_NON_WORD:
+            return BONUS_BOUNDARY
+    if (prev_class == CHAR_LOWER and charclass == CHAR_UPPER) or (prev_class != CHAR_NUMBER and charclass == CHAR_NUMBER):
+        return BONUS_CAMEL_123
+    if charclass in (CHAR_NON_WORD, CHAR_DELIMITER):
+        return BONUS_NON_WORD
+    elif charclass == CHAR_WHITE:
+        return BONUS_BOUNDARY_WHITE
     return 0
 
+ASCII_CLASS_TABLE = bytes(char_class_of(chr(c)) for c in range(128)) + bytes(128)
+BONUS_MATRIX = [[bonus_for(prev, cur) for cur in range(7)] for prev in range(7)]
+
 def bonus_at(input, idx):
     if idx == 0:
-        return 10
-    return bonus_for(char_class_of(input[idx - 1]), char_class_of(input[idx]))
+        return BONUS_BOUNDARY_WHITE
+    return BONUS_MATRIX[char_class_of(input[idx - 1])][char_class_of(input[idx])]
+
+def fold_rune(char, case_sensitive, normalize):
+    if not case_sensitive:
+        lower = char.lower()
+        if len(lower) == 1:
+            char = lower
+    if normalize and ord(char) >= 128:
+        char = normalize_rune(char)
+    return char
+
+class Slab:
+    """Preallocated DP buffers, reused across fuzzymatch_v2 calls."""
+
+    def __init__(self, size16=SLAB_16_SIZE, size32=SLAB_32_SIZE):
+        self.i16 = [0] * size16
+        self.i32 = [0] * size32
+
+_slabs = threading.local()
+
+def get_slab():
+    slab = getattr(_slabs, "slab", None)
+    if slab is None:
+        slab = _slabs.slab = Slab()
+    return slab
+
+class Prepared:
+    """A candidate with its folded text and char classes, computed once.
+
+    folded holds one char per char of text (lowercased unless case_sensitive,
+    NFKD-reduced with normalize) and classes one char class byte per char, so
+    the matchers only index into them.
+    """
+
+    __slots__ = ("text", "folded", "classes", "ascii")
+
+    def __init__(self, text, folded, classes, ascii):
+        self.text = text
+        self.folded = folded
+        self.classes = classes
+        self.ascii = ascii
+
+    def __len__(self):
+        return len(self.text)
+
+def fold_text(text, case_sensitive, normalize=False):
+    if text.isascii():
+        return text if case_sensitive else text.lower()
+    return "".join([fold_rune(char, case_sensitive, normalize) for char in text])
+
+def classes_of(text):
+    if text.isascii():
+        return text.encode("ascii").translate(ASCII_CLASS_TABLE)
+    return bytes([char_class_of(char) for char in text])
+
+def prepare(text, case_sensitive=False, normalize=False):
+    if isinstance(text, Prepared):
+        return text
+    return Prepared(text, fold_text(text, case_sensitive, normalize), classes_of(text), text.isascii())
 
 def ascii_fuzzy_index(input, pattern, case_sensitive):
     if not is_ascii(pattern):
         return -1, -1
+    input = prepare(input, case_sensitive)
+    if not input.ascii:
+        # Can't narrow by byte search
+        return 0, len(input)
+    # Pattern chars are already folded, so a plain find on the folded text will do
+    folded = input.folded
     idx = 0
     first_idx = 0
     last_idx = 0
     for pidx, pchar in enumerate(pattern):
-        if case_sensitive:
-            idx = input.find(pchar, idx)
-        else:
-            idx = re.search(pchar, input[idx:], re.IGNORECASE)
-            if idx:
-                idx = idx.start() + idx.pos
-            else:
-                idx = -1
+        idx = folded.find(pchar, idx)
         if idx < 0:
             return -1, -1
         if pidx == 0 and idx > 0:
             first_idx = idx - 1
         last_idx = idx
         idx += 1
-    return first_idx, last_idx + 1
 
-def fuzzymatch_v2(case_sensitive, normalize, forward, input, pattern, with_pos):
-    if len(pattern) == 0:
-        return (0, 0, 0), None
-    if len(input) < len(pattern):
+    # Extend the scope to the last occurrence of the last pattern char
+    end = folded.rfind(pattern[-1], last_idx)
+    return first_idx, end + 1
+
+def calculate_score(case_sensitive, normalize, input, pattern, sidx, eidx, with_pos):
+    input = prepare(input, case_sensitive, normalize)
+    folded, classes = input.folded, input.classes
+    pidx, score, in_gap, consecutive, first_bonus = 0, 0, False, 0, 0
+    pos = [] if with_pos else None
+    prev_class = INITIAL_CHAR_CLASS
+    if sidx > 0:
+        prev_class = classes[sidx - 1]
+    for idx in range(sidx, eidx):
+        charclass = classes[idx]
+        if folded[idx] == pattern[pidx]:
+            if with_pos:
+                pos.append(idx)
+            score += SCORE_MATCH
+            bonus = BONUS_MATRIX[prev_class][charclass]
+            if consecutive == 0:
+                first_bonus = bonus
+            else:
+                # Break consecutive chunk
+                if bonus >= BONUS_BOUNDARY and bonus > first_bonus:
+                    first_bonus = bonus
+                bonus = max(bonus, first_bonus, BONUS_CONSECUTIVE)
+            if pidx == 0:
+                score += bonus * BONUS_FIRST_CHAR_MULTIPLIER
+            else:
+                score += bonus
+            in_gap = False
+            consecutive += 1
+            pidx += 1
+        else:
+            score += SCORE_GAP_EXTENSION if in_gap else SCORE_GAP_START
+            in_gap = True
+            consecutive = 0
+            first_bonus = 0
+        prev_class = charclass
+    return score, pos
+
+def fuzzymatch_v2(case_sensitive, normalize, forward, input, pattern, with_pos, slab=None):
+    """fzf's optimal alignment matcher: ((sidx, eidx, score), positions).
+
+    input is a str or a Prepared candidate. sidx is exact only with
+    with_pos; positions are ascending indices into input.
+    """
+    M = len(pattern)
+    if M == 0:
+        return (0, 0, 0), ([] if with_pos else None)
+    if len(input) < M:
         return (-1, -1, 0), None
+    input = prepare(input, case_sensitive, normalize)
 
-    idx, _ = ascii_fuzzy_index(input, pattern, case_sensitive)
-    if idx < 0:
+    # Phase 1. Narrow the input to the window that can hold a match
+    min_idx, max_idx = ascii_fuzzy_index(input, pattern, case_sensitive)
+    if min_idx < 0:
         return (-1, -1, 0), None
+    return _fuzzymatch_v2_window(case_sensitive, normalize, forward, input, pattern, with_pos, slab, min_idx, max_idx,
+                                 input.folded[min_idx:max_idx], input.classes[min_idx:max_idx])
 
-    pidx = 0
-    sidx = -1
-    eidx = -1
-    len_input = len(input)
-    len_pattern = len(pattern)
+def _fuzzymatch_v2_window(case_sensitive, normalize, forward, input, pattern, with_pos, slab, min_idx, max_idx, T, classes):
+    # T and classes are the folded text and char classes of input[min_idx:max_idx]
+    M = len(pattern)
+    N = max_idx - min_idx
+    if slab is None:
+        slab = get_slab()
+    if 3 * N + 2 * N * M > len(slab.i16) or M > len(slab.i32):
+        return fuzzymatch_v1(case_sensitive, normalize, forward, input, pattern, with_pos)
+
+    # S holds H0, C0 and B (first-row scores, consecutive counts, per-position bonus), then H and C
+    S = slab.i16
+    F = slab.i32
+    c0, b0 = N, 2 * N
+
+    # Phase 2. Compute bonuses and the first row
+    max_score, max_score_pos = 0, 0
+    pidx, last_idx = 0, 0
+    pchar0 = pchar = pattern[0]
+    prev_h0, prev_class, in_gap = 0, INITIAL_CHAR_CLASS, False
+    for off in range(N):
+        char = T[off]
+        charclass = classes[off]
+        bonus = S[b0 + off] = BONUS_MATRIX[prev_class][charclass]
+        prev_class = charclass
 
-    for index in range(len_input):
-        index_ = index if forward else len_input - index - 1
-        char = input[index_]
-        if not case_sensitive:
-            char = char.lower()
-        if normalize:
-            char = normalize_rune(char)
-        pchar = pattern[pidx if forward else len_pattern - pidx - 1]
         if char == pchar:
-            if sidx < 0:
-                sidx = index
-            if pidx + 1 == len_pattern:
-                eidx = index + 1
-                break
-            pidx += 1
-        else:
-            index -= pidx
-            pidx = 0
+            if pidx < M:
+                F[pidx] = off
+                pidx += 1
+                if pidx < M:
+                    pchar = pattern[pidx]
+            last_idx = off
 
-    if sidx >= 0 and eidx >= 0:
-        pidx -= 1
-        for index in range(eidx - 1, sidx - 1, -1):
-            tidx = index if forward else len_input - index - 1
-            char = input[tidx]
-            if not case_sensitive:
-                char = char.lower()
-            pidx_ = pidx if forward else len_pattern - pidx - 1
-            pchar = pattern[pidx_]
-            if char == pchar:
-                if pidx - 1 < 0:
-                    sidx = index
+        if char == pchar0:
+            score = S[off] = SCORE_MATCH + bonus * BONUS_FIRST_CHAR_MULTIPLIER
+            S[c0 + off] = 1
+            if M == 1 and (score > max_score if forward else score >= max_score):
+                max_score, max_score_pos = score, off
+                if forward and bonus >= BONUS_BOUNDARY:
                     break
-                pidx -= 1
+            in_gap = False
+        else:
+            prev_h0 += SCORE_GAP_EXTENSION if in_gap else SCORE_GAP_START
+            score = S[off] = prev_h0 if prev_h0 > 0 else 0
+            S[c0 + off] = 0
+            in_gap = True
+        prev_h0 = score
 
-        if not forward:
-            sidx, eidx = len_input - eidx, len_input - sidx
-        return (sidx, eidx, 0), None
+    if pidx != M:
+        return (-1, -1, 0), None
+    if M == 1:
+        result = (min_idx + max_score_pos, min_idx + max_score_pos + 1, max_score)
+        return result, ([min_idx + max_score_pos] if with_pos else None)
 
-    return (-1, -1, 0), None
+    # Phase 3. Fill in the score matrix H (and consecutive chunk lengths C), one row per pattern char
+    f0 = F[0]
+    width = last_idx - f0 + 1
+    h = 3 * N
+    c = h + width * M
+    S[h:h + width] = S[f0:last_idx + 1]
+    S[c:c + width] = S[c0 + f0:c0 + last_idx + 1]
+
+    last_row = M - 1
+    for pidx in range(1, M):
+        f = F[pidx]
+        pchar = pattern[pidx]
+        # Flat offsets of (row, col) in H and of (row - 1, col - 1) in H and C
+        hcell = h + pidx * width + f - f0
+        diag = hcell - h - width - 1
+        in_gap = False
+        S[hcell - 1] = 0
+        for col in range(f, last_idx + 1):
+            s2 = S[hcell - 1] + (SCORE_GAP_EXTENSION if in_gap else SCORE_GAP_START)
+            consecutive = 0
+            if pchar == T[col]:
+                s1 = S[h + diag] + SCORE_MATCH
+                b = S[b0 + col]
+                consecutive = S[c + diag] + 1
+                if consecutive > 1:
+                    fb = S[b0 + col - consecutive + 1]
+                    # Break consecutive chunk
+                    if b >= BONUS_BOUNDARY and b > fb:
+                        consecutive = 1
+                    else:
+                        if b < BONUS_CONSECUTIVE:
+                            b = BONUS_CONSECUTIVE
+                        if b < fb:
+                            b = fb
+                if s1 + b < s2:
+                    s1 += S[b0 + col]
+                    consecutive = 0
+                else:
+                    s1 += b
+                in_gap = s1 < s2
+                score = s2 if in_gap else s1
+            else:
+                in_gap = 0 < s2
+                score = s2 if in_gap else 0
+            if score < 0:
+                score = 0
+            S[c + diag + width + 1] = consecutive
+            S[hcell] = score
+            if pidx == last_row and (score > max_score if forward else score >= max_score):
+                max_score, max_score_pos = score, col
+            hcell += 1
+            diag += 1
+
+    # Phase 4. Backtrace the match positions
+    pos = None
+    j = f0
+    if with_pos:
+        pos = []
+        i = M - 1
+        j = max_score_pos
+        prefer_match = True
+        while True:
+            row = i * width
+            j0 = j - f0
+            s = S[h + row + j0]
+
+            s1 = s2 = 0
+            if i > 0 and j >= F[i]:
+                s1 = S[h + row - width + j0 - 1]
+            if j > F[i]:
+                s2 = S[h + row + j0 - 1]
+
+            if s > s1 and (s > s2 or (s == s2 and prefer_match)):
+                pos.append(min_idx + j)
+                if i == 0:
+                    break
+                i -= 1
+            prefer_match = S[c + row + j0] > 1 or (
+                i + 1 < M and j + 1 >= F[i + 1] and S[c + row + width + j0 + 1] > 0)
+            j -= 1
+        pos.reverse()
+
+    return (min_idx + j, min_idx + max_score_pos + 1, max_score), pos
 
 def fuzzymatch_v1(case_sensitive, normalize, forward, input, pattern, with_pos):
+    """fzf's greedy matcher: leftmost match, shrunk from the right, then scored."""
     if len(pattern) == 0:
-        return (0, 0, 0), None
+        return (0, 0, 0), ([] if with_pos else None)
 
+    input = prepare(input, case_sensitive, normalize)
     idx, _ = ascii_fuzzy_index(input, pattern, case_sensitive)
     if idx < 0:
         return (-1, -1, 0), None
+    folded = input.folded
 
     pidx = 0
     sidx = -1
@@ -138,40 +368,186 @@ def fuzzymatch_v1(case_sensitive, normalize, forward, input, pattern, with_pos):
 
     for index in range(len_input):
         index_ = index if forward else len_input - index - 1
-        char = input[index_]
-        if not case_sensitive:
-            char = char.lower()
-        if normalize:
-            char = normalize_rune(char)
+        char = folded[index_]
         pchar = pattern[pidx if forward else len_pattern - pidx - 1]
         if char == pchar:
             if sidx < 0:
                 sidx = index
-            if pidx + 1 == len_pattern:
+            pidx += 1
+            if pidx == len_pattern:
                 eidx = index + 1
                 break
-            pidx += 1
-        else:
-            index -= pidx
-            pidx = 0
 
     if sidx >= 0 and eidx >= 0:
         pidx -= 1
         for index in range(eidx - 1, sidx - 1, -1):
             tidx = index if forward else len_input - index - 1
-            char = input[tidx]
-            if not case_sensitive:
-                char = char.lower()
+            char = folded[tidx]
             pidx_ = pidx if forward else len_pattern - pidx - 1
             pchar = pattern[pidx_]
             if char == pchar:
-                if pidx - 1 < 0:
+                pidx -= 1
+                if pidx < 0:
                     sidx = index
                     break
-                pidx -= 1
 
         if not forward:
             sidx, eidx = len_input - eidx, len_input - sidx
-        return (sidx, eidx, 0), None
+        score, pos = calculate_score(case_sensitive, normalize, input, pattern, sidx, eidx, with_pos)
+        return (sidx, eidx, score), pos
 
     return (-1, -1, 0), None
+
+class Corpus:
+    """Candidate strings packed into one contiguous byte buffer for batch matching.
+
+    The folded text and char classes of every item are packed the same way,
+    once per case sensitivity, and sliced out by prepared().
+    """
+
+    def __init__(self, items):
+        self.items = list(items)
+        lengths = np.fromiter(map(len, self.items), dtype=np.int64, count=len(self.items))
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+        self.ascii = np.fromiter(map(str.isascii, self.items), dtype=bool, count=len(self.items))
+        self._folded = {}
+        self._classes = None
+        self._buffers = {}
+        self._occurrences = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def extend(self, items):
+        items = list(items)
+        base = int(self.ends[-1]) if len(self.ends) else 0
+        lengths = np.fromiter(map(len, items), dtype=np.int64, count=len(items))
+        ends = base + np.cumsum(lengths)
+        self.items.extend(items)
+        self.ends = np.concatenate((self.ends, ends))
+        self.starts = np.concatenate((self.starts, ends - lengths))
+        self.ascii = np.concatenate((self.ascii, np.fromiter(map(str.isascii, items), dtype=bool, count=len(items))))
+        # Packed text, buffers and occurrence lists only grow at the end
+        text = "".join(items)
+        for case_sensitive, folded in self._folded.items():
+            self._folded[case_sensitive] = folded + fold_text(text, case_sensitive)
+        if self._classes is not None:
+            self._classes += classes_of(text)
+        for case_sensitive, buffer in self._buffers.items():
+            self._buffers[case_sensitive] = np.concatenate((buffer, _pack(self._folded[case_sensitive][base:])))
+        for (code, case_sensitive), occ in self._occurrences.items():
+            added = np.flatnonzero(self._buffers[case_sensitive][base:] == code) + base
+            self._occurrences[code, case_sensitive] = np.concatenate((occ, added))
+
+    def folded(self, case_sensitive):
+        if case_sensitive not in self._folded:
+            self._folded[case_sensitive] = fold_text("".join(self.items), case_sensitive)
+        return self._folded[case_sensitive]
+
+    def classes(self):
+        if self._classes is None:
+            self._classes = classes_of("".join(self.items))
+        return self._classes
+
+    def prepared(self, i, case_sensitive):
+        start, end = int(self.starts[i]), int(self.ends[i])
+        return Prepared(self.items[i], self.folded(case_sensitive)[start:end], self.classes()[start:end], bool(self.ascii[i]))
+
+    def buffer(self, case_sensitive):
+        if case_sensitive not in self._buffers:
+            self._buffers[case_sensitive] = _pack(self.folded(case_sensitive))
+        return self._buffers[case_sensitive]
+
+    def occurrences(self, code, case_sensitive):
+        # Sorted positions of one byte code in the packed buffer, computed once per corpus
+        key = (code, case_sensitive)
+        if key not in self._occurrences:
+            self._occurrences[key] = np.flatnonzero(self.buffer(case_sensitive) == code)
+        return self._occurrences[key]
+
+def _pack(folded):
+    # Non-ASCII chars pack to 0x80 so they never equal an (ASCII) pattern char
+    if folded.isascii():
+        return np.frombuffer(folded.encode("ascii"), dtype=np.uint8)
+    return np.fromiter((min(ord(c), 0x80) for c in folded), dtype=np.uint8, count=len(folded))
+
+def batch_candidates(corpus, pattern, case_sensitive=False, candidates=None):
+    """Indices of the corpus items that contain pattern as a subsequence.
+
+    With candidates (an index array), only those items are considered.
+    """
+    slots = _batch_scan(corpus, pattern, case_sensitive, candidates)[0]
+    return slots if candidates is None else np.asarray(candidates, dtype=np.int64)[slots]
+
+def _batch_scan(corpus, pattern, case_sensitive, candidates=None):
+    # One vectorized searchsorted pass per pattern char finds, for every
+    # candidate at once, the next occurrence of that char after the previous
+    # one. Returns the survivors' positions in candidates (or the corpus) and
+    # the ascii_fuzzy_index window of each.
+    alive = np.arange(len(corpus)) if candidates is None else np.asarray(candidates, dtype=np.int64)
+    slots = np.arange(len(alive))
+    empty = slots[:0]
+    if len(pattern) == 0:
+        return slots, np.zeros_like(slots), np.zeros_like(slots)
+    if not is_ascii(pattern):
+        return empty, empty, empty
+
+    pos = corpus.starts[alive]
+    ends = corpus.ends
+    first = None
+    for pchar in pattern:
+        occ = corpus.occurrences(ord(pchar), case_sensitive)
+        if len(occ) == 0 or len(alive) == 0:
+            return empty, empty, empty
+        j = np.searchsorted(occ, pos)
+        found = j < len(occ)
+        nxt = np.where(found, occ[np.minimum(j, len(occ) - 1)], 0)
+        ok = found & (nxt < ends[alive])
+        alive = alive[ok]
+        slots = slots[ok]
+        pos = nxt[ok] + 1
+        first = pos - 1 if first is None else first[ok]
+
+    # Window: one char before the first match to the last occurrence of the last char
+    starts = corpus.starts[alive]
+    ends = ends[alive]
+    last = occ[np.searchsorted(occ, ends) - 1]
+    min_idx = np.maximum(first - starts - 1, 0)
+    max_idx = last - starts + 1
+    # ascii_fuzzy_index does not narrow non-ASCII inputs
+    wide = ~corpus.ascii[alive]
+    min_idx[wide] = 0
+    max_idx[wide] = (ends - starts)[wide]
+    return slots, min_idx, max_idx
+
+def fuzzymatch_batch(corpus, pattern, case_sensitive=False, candidates=None):
+    """Forward, non-normalizing fuzzymatch_v2 over every candidate of a Corpus.
+
+    Only candidates that survive the vectorized subsequence scan are scored.
+    Returns (sidx, eidx, score) arrays indexed like corpus.items (or like
+    candidates, when given), with -1 spans for misses.
+    """
+    if candidates is not None:
+        candidates = np.asarray(candidates, dtype=np.int64)
+    count = len(corpus) if candidates is None else len(candidates)
+    sidx = np.full(count, -1, dtype=np.int64)
+    eidx = np.full(count, -1, dtype=np.int64)
+    score = np.zeros(count, dtype=np.int64)
+    if len(pattern) == 0:
+        sidx[:] = 0
+        eidx[:] = 0
+        return sidx, eidx, score
+
+    slab = get_slab()
+    items = corpus.items
+    folded = corpus.folded(case_sensitive)
+    classes = corpus.classes()
+    slots, min_idx, max_idx = _batch_scan(corpus, pattern, case_sensitive, candidates)
+    alive = slots if candidates is None else candidates[slots]
+    lo = (corpus.starts[alive] + min_idx).tolist()
+    hi = (corpus.starts[alive] + max_idx).tolist()
+    for i, slot, a, b, start, end in zip(alive.tolist(), slots.tolist(), min_idx.tolist(), max_idx.tolist(), lo, hi):
+        (sidx[slot], eidx[slot], score[slot]), _ = _fuzzymatch_v2_window(
+            case_sensitive, False, True, items[i], pattern, False, slab, a, b, folded[start:end], classes[start:end])
+    return sidx, eidx, score
@@ -0,0 +1,162 @@
+import mmap
+import os
+import re
+from collections import namedtuple
+
+HistoryEntry = namedtuple("HistoryEntry", "timestamp duration command")
+
+META = 0x83
+ZSH_EXTENDED = re.compile(rb": *(\d+):(\d+);")
+BASH_TIMESTAMP = re.compile(rb"#(\d+)$")
+
+def detect_format(path):
+    name = os.path.basename(str(path))
+    if "fish" in name:
+        return "fish"
+    if "bash" in name:
+        return "bash"
+    return "zsh"
+
+def unmetafy(line):
+    # zsh stores bytes that clash with its tokens as Meta followed by the byte xor 32
+    if META not in line:
+        return line
+    out = bytearray()
+    chunks = line.split(bytes((META,)))
+    out += chunks[0]
+    for chunk in chunks[1:]:
+        if chunk:
+            out.append(chunk[0] ^ 32)
+            out += chunk[1:]
+    return bytes(out)
+
+def decode(line):
+    return line.decode("utf-8", errors="replace")
+
+def iter_lines(buf, start=0):
+    """(end, HistoryEntry) for each line, one command per line."""
+    size = len(buf)
+    pos = start
+    while pos < size:
+        nl = buf.find(b"\n", pos)
+        end = size if nl < 0 else nl + 1
+        line = buf[pos:end].rstrip(b"\n")
+        if line:
+            yield end, HistoryEntry(0, 0, decode(line))
+        pos = end
+
+def iter_zsh(buf, start=0):
+    """(end, HistoryEntry) for each zsh entry, plain or EXTENDED_HISTORY.
+
+    Lines ending in a backslash continue the command on the next line; an
+    entry still continuing at the end of the buffer is not yielded.
+    """
+    size = len(buf)
+    pos = start
+    while pos < size:
+        parts = []
+        while True:
+            nl = buf.find(b"\n", pos)
+            if nl < 0:
+                parts.append(buf[pos:size])
+                pos = size
+                break
+            line = buf[pos:nl]
+            pos = nl + 1
+            if line.endswith(b"\\") and pos < size:
+                parts.append(line[:-1])
+                continue
+            if line.endswith(b"\\"):
+                # Continued past what has been written so far
+                return
+            parts.append(line)
+            break
+        raw = unmetafy(b"\n".join(parts))
+        if not raw:
+            continue
+        timestamp = duration = 0
+        match = ZSH_EXTENDED.match(raw)
+        if match:
+            timestamp, duration = int(match.group(1)), int(match.group(2))
+            raw = raw[match.end():]
+        yield pos, HistoryEntry(timestamp, duration, decode(raw))
+
+def iter_bash(buf, start=0):
+    """(end, HistoryEntry) for each bash entry, with HISTTIMEFORMAT "#<epoch>" lines."""
+    size = len(buf)
+    pos = start
+    timestamp = 0
+    while pos < size:
+        nl = buf.find(b"\n", pos)
+        end = size if nl < 0 else nl + 1
+        line = buf[pos:end].rstrip(b"\n")
+        pos = end
+        match = BASH_TIMESTAMP.match(line)
+        if match:
+            timestamp = int(match.group(1))
+        elif line:
+            yield end, HistoryEntry(timestamp, 0, decode(line))
+            timestamp = 0
+
+def unescape_fish(value):
+    return value.replace(b"\\n", b"\n").replace(b"\\\\", b"\\")
+
+def iter_fish(buf, start=0):
+    """(end, HistoryEntry) for each "- cmd:" record of a fish_history file.
+
+    A record is complete once the next one starts or the buffer ends.
+    """
+    size = len(buf)
+    pos = start
+    command = None
+    timestamp = 0
+    entry_end = start
+    while pos < size:
+        nl = buf.find(b"\n", pos)
+        end = size if nl < 0 else nl + 1
+        line = buf[pos:end].rstrip(b"\n")
+        if line.startswith(b"- cmd: "):
+            if command is not None:
+                yield entry_end, HistoryEntry(timestamp, 0, decode(unescape_fish(command)))
+            command, timestamp = line[7:], 0
+        elif line.startswith(b"  when: ") and command is not None:
+            timestamp = int(line[8:] or 0)
+        entry_end = end
+        pos = end
+    if command is not None:
+        yield entry_end, HistoryEntry(timestamp, 0, decode(unescape_fish(command)))
+
+def format_zsh(entry):
+    """entry as an EXTENDED_HISTORY line (a plain line without a timestamp)."""
+    command = entry.command.replace("\n", "\\\n")
+    if entry.timestamp:
+        return f": {entry.timestamp}:{entry.duration};{command}\n"
+    return command + "\n"
+
+PARSERS = {
+    "lines": iter_lines,
+    "zsh": iter_zsh,
+    "bash": iter_bash,
+    "fish": iter_fish,
+}
+
+def map_file(path):
+    """Read-only mmap of path, or None for a missing or empty file."""
+    try:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+
+def read_history(path, fmt=None, start=0):
+    """Lazily yield (end_offset, HistoryEntry) from a history file, starting at byte start."""
+    buf = map_file(path)
+    if buf is None:
+        return
+    parse = PARSERS[fmt or detect_format(path)]
+    try:
+        yield from parse(buf, start)
+    finally:
+        buf.close()
@@ -1,120 +1,587 @@
+import fcntl
 import os
 from pathlib import Path
-import subprocess
-from .fuzzy import fuzzymatch_v2
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from .fuzzy import Corpus, fuzzymatch_batch, fuzzymatch_v2
+from .frecency import Frecency, FrecencyStore
+from .histfile import PARSERS, HistoryEntry, detect_format, format_zsh, iter_zsh, map_file, read_history
+from .ngram import NgramIndex
+from .trace import span, traced
 
 HISTORY_FILE = Path.home() / ".tnkos_history"
 SHELL_HISTORY_FILE = Path.home() / ".zsh_history"  # Adjust the file path based on your shell
+HISTORY_MAX_ENTRIES = 50000
+# Points of fuzzy score per doubling of a command's frecency
+FRECENCY_WEIGHT = 4
+# Seconds of quiet typing before a history search starts
+SEARCH_DEBOUNCE = 0.05
+
+def frecency_file(history_file):
+    """Where the FrecencyStore of a history file lives: right next to it."""
+    return Path(f"{history_file}.frecency")
 
 def load_history():
-    if not HISTORY_FILE.exists():
-        return []
-    with open(HISTORY_FILE, "r") as file:
-        return file.read().splitlines()
+    return [entry.command for _, entry in read_history(HISTORY_FILE, "zsh")]
+
+def save_history(entries, path=HISTORY_FILE):
+    # Write a sibling temp file and rename it over the history, so a crash leaves one or the other
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write("".join(format_zsh(entry if isinstance(entry, HistoryEntry) else HistoryEntry(0, 0, entry)) for entry in entries))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+class HistoryWriter:
+    """Appends commands to the history file as zsh EXTENDED_HISTORY lines.
+
+    Each command is one append and flush; fsync runs at most every
+    fsync_interval seconds (every append with 0, never with None).
+
+    Several tnkos processes may share the file. Appends hold a shared
+    flock on a sibling ".lock" file and compaction holds it exclusively
+    while it reads the tail and renames, so no append lands in a file
+    being replaced; an append that finds the file replaced since it was
+    opened reopens it first.
+    """
+
+    def __init__(self, path=HISTORY_FILE, fsync_interval=1.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self.lock_file = None
+        self.last_sync = 0.0
+        self.lock = threading.Lock()
+
+    def append(self, command, timestamp=None):
+        entry = HistoryEntry(int(time.time() if timestamp is None else timestamp), 0, command)
+        with self.lock, self._file_lock(fcntl.LOCK_SH):
+            if self.file is not None and self._replaced():
+                self.file.close()
+                self.file = None
+            if self.file is None:
+                self._open()
+            self.file.write(format_zsh(entry))
+            self.file.flush()
+            if self.fsync_interval is not None and time.monotonic() - self.last_sync >= self.fsync_interval:
+                self._sync()
+
+    @contextmanager
+    def _file_lock(self, operation):
+        # Callers hold self.lock
+        if self.lock_file is None:
+            self.lock_file = open(f"{self.path}.lock", "a")
+        fcntl.flock(self.lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _replaced(self):
+        # Another process compacted the file: our handle points at the old one
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _open(self):
+        self.file = open(self.path, "a")
+        if self.file.tell() > 0:
+            with open(self.path, "rb") as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    # Older files were written without a trailing newline
+                    self.file.write("\n")
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+            if self.lock_file is not None:
+                self.lock_file.close()
+                self.lock_file = None
+
+    def save_cwds(self, cwds):
+        """Store the directories each command last ran in, for the next session."""
+        with self.lock:
+            store = FrecencyStore(frecency_file(self.path)).load()
+            store.cwds = cwds
+            store.save()
+
+    def compact(self, max_entries=HISTORY_MAX_ENTRIES, cwds=None):
+        """Rewrite the file without duplicates (keeping the latest use), capped at max_entries.
 
-def save_history(commands):
-    with open(HISTORY_FILE, "w") as file:
-        file.write("\n".join(commands))
+        The uses dropped are added to the file's FrecencyStore, so frecency
+        still counts every run; cwds, when given, replaces the directories
+        stored. The slow part runs without the locks; only commands appended
+        meanwhile are read under them, right before the atomic rename. A
+        file without duplicates or overflow is left as it is.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            data = file.read()
+        entries = [entry for _, entry in iter_zsh(data)]
+        with self.lock, self._file_lock(fcntl.LOCK_EX):
+            if self.file is not None:
+                self.file.flush()
+            with open(self.path, "rb") as file:
+                file.seek(len(data))
+                entries.extend(entry for _, entry in iter_zsh(file.read()))
+            kept = dedupe_entries(entries)[-max_entries:]
+            if len(kept) == len(entries):
+                return
+            store = FrecencyStore(frecency_file(self.path)).load()
+            runs = Counter(entry.command for entry in entries)
+            store.uses = {
+                entry.command: uses for entry in kept
+                if (uses := store.uses.get(entry.command, 0) + runs[entry.command] - 1)
+            }
+            if cwds is None:
+                cwds = store.cwds
+            store.cwds = {entry.command: cwds[entry.command] for entry in kept if entry.command in cwds}
+            # Saved first: a crash in between overcounts the dropped uses instead of losing them
+            store.save()
+            save_history(kept, self.path)
+            # The old handle points at the replaced file
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def dedupe_entries(entries):
+    """Drop all but the last use of each command, keeping order."""
+    seen = set()
+    kept = []
+    for entry in reversed(entries):
+        if entry.command and entry.command not in seen:
+            seen.add(entry.command)
+            kept.append(entry)
+    kept.reverse()
+    return kept
+
+history_writer = HistoryWriter()
 
 def add_command_to_history(command):
-    commands = load_history()
-    commands.append(command)
-    save_history(commands)
+    history_writer.append(command)
+
+@traced("history.compact")
+def compact_history(max_entries=HISTORY_MAX_ENTRIES):
+    history_writer.compact(max_entries, history_store.cwds() if history_store.loaded else None)
+
+def save_frecency():
+    """Keep this session's cwds for the next one; counts live in the history itself."""
+    if history_store.loaded:
+        history_writer.save_cwds(history_store.cwds())
+
+class HistorySearch:
+    """Fuzzy search over a list of commands that narrows as the query grows.
+
+    Keeps a stack of (query, matches, scores), each query a prefix of the
+    next. A query that extends the top of the stack only rescans its
+    matches; one that doesn't (backspace, edits) pops back to the longest
+    cached prefix.
+
+    With a Frecency whose ids match the command positions, results are
+    ranked by fuzzy score plus frecency.
+    """
+
+    def __init__(self, commands, frecency=None):
+        self.corpus = Corpus(commands)
+        self.commands = self.corpus.items
+        self.frecency = frecency
+        self.index = NgramIndex(self.corpus)
+        self.stack = []
+
+    def extend(self, commands):
+        start = len(self.corpus)
+        self.corpus.extend(commands)
+        self.index.extend()
+        # Run the new commands down the stack so cached results stay complete
+        candidates = np.arange(start, len(self.corpus))
+        for level, (query, matched, score) in enumerate(self.stack):
+            sidx, _, new_score = fuzzymatch_batch(self.corpus, query, candidates=candidates)
+            hits = np.flatnonzero(sidx >= 0)
+            candidates = candidates[hits]
+            self.stack[level] = (query, np.concatenate((matched, candidates)), np.concatenate((score, new_score[hits])))
+
+    def matches(self, query):
+        while self.stack and not query.startswith(self.stack[-1][0]):
+            self.stack.pop()
+        if self.stack and self.stack[-1][0] == query:
+            return self.stack[-1][1:]
+
+        # Only the previous matches can match a longer query; without any, ask the index
+        candidates = self.stack[-1][1] if self.stack else self.index.candidates(query)
+        sidx, _, score = fuzzymatch_batch(self.corpus, query, candidates=candidates)
+        hits = np.flatnonzero(sidx >= 0)
+        matched = hits if candidates is None else candidates[hits]
+        self.stack.append((query, matched, score[hits]))
+        return matched, score[hits]
+
+    def search(self, query, max_items=50, cwd=None):
+        matched, score = self.matches(query)
+        if self.frecency is None:
+            # Best score first; ties go to the most recent command
+            order = matched[np.lexsort((-matched, -score))][:max_items]
+        else:
+            rank = score + FRECENCY_WEIGHT * np.log2(1 + self.frecency.scores(matched, cwd=cwd))
+            order = matched[np.lexsort((-self.frecency.recency(matched).astype(np.int64), -rank))][:max_items]
+
+        results = []
+        for i in order:
+            command = self.commands[i]
+            result, positions = fuzzymatch_v2(False, False, True, self.corpus.prepared(i, False), query, True)
+            results.append((command, result, positions))
+        return results
+
+class HistoryFile:
+    """One history file, re-read only as far as it changed.
+
+    refresh() stats the file: growth parses just the appended bytes,
+    truncation, replacement or an in-place rewrite asks for a reload,
+    which entries() parses from the mmap again. Entries are not kept
+    here; whoever reads them keeps what it needs.
+    """
+
+    def __init__(self, path, fmt=None):
+        self.path = path
+        self.parse = PARSERS[fmt or detect_format(path)]
+        self.offset = 0
+        self.stat = None
+        # True when the last entry came from an unterminated final line
+        self.partial = False
 
-def search_command_history(query, max_items=50):
-    tnikos_commands = load_history()
-    shell_commands = load_shell_history()
+    def refresh(self):
+        """Returns (reloaded, appended_entries); after a reload, read the file with entries()."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+        old = self.stat
+        self.stat = stat
+        if stat is None:
+            self.offset = 0
+            self.partial = False
+            return old is not None, []
+        if old is not None and (stat.st_ino, stat.st_size, stat.st_mtime_ns) == (old.st_ino, old.st_size, old.st_mtime_ns):
+            return False, []
 
-    all_commands = tnikos_commands + shell_commands
-    scored_commands = []
-    for command in all_commands:
-        result = fuzzymatch_v2(False, False, True, command, query, False)
-        if result[0][0] != -1:
-            scored_commands.append((command, result[0],))
+        rewritten = (
+            old is None
+            or stat.st_ino != old.st_ino
+            or stat.st_size < old.st_size
+            or (stat.st_size == old.st_size and stat.st_mtime_ns != old.st_mtime_ns)
+            or self.partial
+        )
+        if rewritten:
+            self.offset = 0
+            self.partial = False
+            return True, []
+        return False, list(self._parse())
 
+    def entries(self):
+        """Every entry of the file, parsed from the start."""
+        self.offset = 0
+        self.partial = False
+        return self._parse()
 
-    scored_commands.sort(key=lambda x: x[1], reverse=True)
+    def _parse(self):
+        buf = map_file(self.path)
+        if buf is None:
+            return
+        try:
+            for end, entry in self.parse(buf, self.offset):
+                self.offset = end
+                yield entry
+            # An unterminated last line is kept; the next change reloads the file
+            self.partial = self.offset == len(buf) and buf[self.offset - 1:self.offset] != b"\n"
+        finally:
+            buf.close()
 
-    return scored_commands[:max_items]
+class HistoryStore:
+    """tnkos and shell history held in memory for reverse search.
+
+    Loaded once; refresh() picks up what changed on disk so searching
+    itself never touches the files. Commands are deduplicated into a
+    Frecency, so each is matched once however often it was run. Safe to
+    use from worker threads; calls are serialized, except record_cwd,
+    which only queues its record for the next call to apply.
+    """
+
+    def __init__(self, history_file=HISTORY_FILE, shell_history_file=SHELL_HISTORY_FILE):
+        self.files = [HistoryFile(history_file, "zsh"), HistoryFile(shell_history_file)]
+        self.store_file = frecency_file(history_file)
+        self.frecency = None
+        self.searcher = None
+        self.lock = threading.RLock()
+        # (command, cwd) pairs from record_cwd, applied by whoever next holds the lock
+        self.queued_cwds = deque()
+
+    @property
+    def loaded(self):
+        return self.searcher is not None
+
+    @property
+    def commands(self):
+        return self.searcher.commands if self.searcher else []
+
+    @traced("history.load")
+    def load(self):
+        with self.lock:
+            for history_file in self.files:
+                history_file.stat = None
+                history_file.refresh()
+            self._rebuild()
+
+    @traced("history.refresh")
+    def refresh(self):
+        with self.lock:
+            if not self.loaded:
+                return self.load()
+            reloaded = False
+            appended = []
+            for history_file in self.files:
+                file_reloaded, file_appended = history_file.refresh()
+                reloaded = reloaded or file_reloaded
+                appended.extend(file_appended)
+            if reloaded:
+                self._rebuild()
+            elif appended:
+                added = [entry.command for entry in appended if self.frecency.add(entry.command, entry.timestamp)[1]]
+                if added:
+                    self.searcher.extend(added)
+            self._apply_cwds()
+
+    def _rebuild(self):
+        old = self.frecency
+        self.frecency = Frecency()
+        for history_file in self.files:
+            for entry in history_file.entries():
+                self.frecency.add(entry.command, entry.timestamp)
+        store = FrecencyStore(self.store_file).load()
+        for command, uses in store.uses.items():
+            self.frecency.add_uses(command, uses)
+        for command, cwds in store.cwds.items():
+            if command in self.frecency.ids:
+                for cwd in reversed(cwds):
+                    self.frecency.record_cwd(command, cwd)
+        if old is not None:
+            for command, cwds in zip(old.commands, old.cwds):
+                for cwd in reversed(cwds or ()):
+                    self.frecency.record_cwd(command, cwd)
+        self._apply_cwds()
+        self.searcher = HistorySearch(self.frecency.commands, self.frecency)
+
+    def record_cwd(self, command, cwd):
+        # Called from the UI thread: never waits for a load or search holding the lock
+        self.queued_cwds.append((command, cwd))
+
+    def _apply_cwds(self):
+        while self.queued_cwds:
+            self.frecency.record_cwd(*self.queued_cwds.popleft())
+
+    def cwds(self):
+        """{command: [cwd, ...]} for the commands with known directories, latest first."""
+        with self.lock:
+            self._apply_cwds()
+            frecency = self.frecency
+            return {command: list(cwds) for command, cwds in zip(frecency.commands, frecency.cwds) if cwds}
+
+    def search(self, query, max_items=50, cwd=None):
+        with span("history.search", query_len=len(query)) as args:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+                self._apply_cwds()
+                results = self.searcher.search(query, max_items, cwd)
+            args["results"] = len(results)
+            return results
+
+history_store = HistoryStore()
+
+def search_command_history(query, max_items=50, cwd=None):
+    return history_store.search(query, max_items, cwd)
 
 def load_shell_history():
-    if not SHELL_HISTORY_FILE.exists():
-        return []
-    with open(SHELL_HISTORY_FILE, "r") as file:
-        return file.read().splitlines()
+    return [entry.command for _, entry in read_history(SHELL_HISTORY_FILE)]
 
-from textual.widgets import ListView, ListItem, Label, Static
+from textual.cache import LRUCache
+from textual.geometry import Size
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
+from textual.worker import get_current_worker
 from rich.text import Text 
 from rich.style import Style
 
-class HistoryView(ListView):
+MATCH_STYLE = Style(reverse=True)
+# Drawn for the line breaks of multi-line commands, which each take one row
+NEWLINE_MARK = "⏎"
+
+def highlight_command(command, positions):
+    # One char for one, so the match positions still line up
+    text = Text(command.replace("\n", NEWLINE_MARK))
+    for pos in positions:
+        text.stylize(MATCH_STYLE, pos, pos + 1)
+    return text
+
+class HistoryView(ScrollView):
+    """Search results, best at the bottom next to the input, like fzf.
+
+    Only the rows on screen are rendered, each through highlight_command
+    on first display and then from a cache, and a new result list only
+    repaints the rows that differ from the previous one.
+    """
+
+    DEFAULT_CSS = """
+    HistoryView {
+        overflow-x: hidden;
+    }
+    HistoryView > .history-view--selected {
+        background: $accent 40%;
+    }
+    """
+
+    COMPONENT_CLASSES = {"history-view--selected"}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.initialized = False
+        self.results = []
+        # Rank of the selected result, 0 being the best match
+        self.selected = 0
+        self.search_timer = None
+        # Set by search(refresh=True) and cleared only by the worker that
+        # refreshes, so a later search replacing that one still refreshes
+        self.refresh_pending = False
+        # Bumped per search; results of any older one are dropped
+        self.generation = 0
+        self._row_cache = LRUCache(256)
 
     def update(self, query):
-        scored_commands = search_command_history(query)
-
-        if scored_commands:
-            top_command, _ = scored_commands[0]
-
-        items = []
-        for command, (start_idx, end_idx, _) in scored_commands:
-            if command == top_command:
-                continue
-            highlighted_command = Text(command[:start_idx])
-            highlighted_command.append(command[start_idx:end_idx], style=Style(reverse=True))
-            highlighted_command.append(command[end_idx:])
-            items.append(highlighted_command)
-
-        if scored_commands:
-            highlighted_top_command = Text(top_command[:start_idx])
-            highlighted_top_command.append(top_command[start_idx:end_idx], style=Style(reverse=True))
-            highlighted_top_command.append(top_command[end_idx:])
-            items.append(highlighted_top_command)
-
-        # Limit items based on available rows
-        available_rows = self.size.height
-        if len(items) > available_rows:
-            items = items[:available_rows]
-
-        # Pad with blank items if needed
-        while len(items) < available_rows:
-            items.append(Text(""))
-
-        items.reverse()
-
-        if not self.initialized:
-            self.extend(ListItem(Label(item)) for item in items)
-            self.initialized = True
-        else:
-            # Update existing ListItems
-            for index, item in enumerate(items[: len(self.children)]):
-                self.children[index].label.update(item)
+        """Search and show the results right away, on the calling thread."""
+        self.show_results(search_command_history(query, cwd=self.app.current_directory))
 
-            # Add new ListItems if needed
-            if len(items) > len(self.children):
-                self.extend(ListItem(Label(item)) for item in items[len(self.children) :])
+    def search(self, query, refresh=False):
+        """Search in a worker thread once typing pauses; current results stay up meanwhile."""
+        self.refresh_pending = self.refresh_pending or refresh
+        self.generation += 1
+        if self.search_timer is not None:
+            self.search_timer.stop()
+        generation = self.generation
+        cwd = self.app.current_directory
+        self.search_timer = self.set_timer(
+            SEARCH_DEBOUNCE, lambda: self.run_worker(
+                lambda: self._search(query, cwd, generation),
+                group="history-search", exclusive=True, thread=True, exit_on_error=False))
 
-            # Remove excess ListItems if needed
-            if len(items) < len(self.children):
-                for _ in range(len(self.children) - len(items)):
-                    self.children.pop()
+    @traced("history.view.search")
+    def _search(self, query, cwd, generation):
+        worker = get_current_worker()
+        if self.refresh_pending:
+            self.refresh_pending = False
+            history_store.refresh()
+        if worker.is_cancelled or generation != self.generation:
+            return
+        results = search_command_history(query, cwd=cwd)
+        if not worker.is_cancelled:
+            self.app.call_from_thread(self._show_search, results, generation)
 
-    def get_selected_command(self):
-        valid_index = self.validate_index(self.index) 
-        if self.children and valid_index: 
-            return self.children[self.index].label.plain
-        return ""
+    def _show_search(self, results, generation):
+        if generation == self.generation:
+            self.show_results(results)
 
-    def previous_command(self):
-        self.index = self.validate_index( self.index + 1 ) 
+    @traced("history.view.show")
+    def show_results(self, scored_commands):
+        old = [self._row_key(y) for y in range(self.size.height)]
+        self.results = scored_commands
+        self.selected = 0
+        self._layout_rows()
+        self.scroll_end(animate=False, immediate=True)
+        self._refresh_changed(old)
 
+    def _layout_rows(self):
+        self.virtual_size = Size(self.size.width, max(len(self.results), self.size.height))
 
-    def next_command(self):
-        next_index = self.validate_index( self.index - 1 )
-        if self.children[next_index].label.plain != "":
-            self.index = next_index
+    def on_resize(self, event):
+        self._layout_rows()
+        self.scroll_end(animate=False, immediate=True)
+
+    def _rank_at(self, y):
+        # Rank of the result drawn on screen row y, counting up from the bottom row
+        return self.virtual_size.height - 1 - (self.scroll_offset.y + y)
+
+    def _row_key(self, y):
+        rank = self._rank_at(y)
+        if not 0 <= rank < len(self.results):
+            return None
+        command, _, positions = self.results[rank]
+        return command, tuple(positions or ()), rank == self.selected
 
+    def _refresh_changed(self, old):
+        for y in range(self.size.height):
+            if y >= len(old) or self._row_key(y) != old[y]:
+                self.refresh_line(self.scroll_offset.y + y)
 
+    def render_line(self, y):
+        width = self.size.width
+        key = self._row_key(y)
+        if key is None:
+            return Strip.blank(width, self.rich_style)
+        cache_key = key + (width,)
+        strip = self._row_cache.get(cache_key)
+        if strip is None:
+            command, positions, selected = key
+            text = highlight_command(command, positions)
+            text.end = ""
+            text.truncate(width, pad=True)
+            if selected:
+                text.stylize(self.get_component_rich_style("history-view--selected"))
+            strip = Strip(text.render(self.app.console)).crop_extend(0, width, self.rich_style)
+            self._row_cache[cache_key] = strip
+        return strip.apply_style(self.rich_style)
 
+    def on_click(self, event):
+        rank = self._rank_at(event.y)
+        if 0 <= rank < len(self.results):
+            self.select(rank)
+
+    def select(self, rank):
+        old = [self._row_key(y) for y in range(self.size.height)]
+        self.selected = rank
+        # Keep the selection on screen
+        row = self.virtual_size.height - 1 - rank
+        if row < self.scroll_offset.y:
+            self.scroll_to(y=row, animate=False, immediate=True)
+        elif row >= self.scroll_offset.y + self.size.height:
+            self.scroll_to(y=row - self.size.height + 1, animate=False, immediate=True)
+        self._refresh_changed(old)
+
+    def get_selected_command(self):
+        if 0 <= self.selected < len(self.results):
+            return self.results[self.selected][0]
+        return ""
+
+    def previous_command(self):
+        # One row up: the next worse match
+        if self.selected + 1 < len(self.results):
+            self.select(self.selected + 1)
+
+    def next_command(self):
+        if self.selected > 0:
+            self.select(self.selected - 1)
@@ -0,0 +1,84 @@
+"""Shared HTTP clients: one long-lived connection pool per endpoint.
+
+Requests to the same scheme, host and port reuse the same httpx.Client,
+so keep-alive connections (and their TLS sessions) outlive any one
+request; async code gets an httpx.AsyncClient per endpoint and event
+loop the same way. HTTP/2 is offered when the h2 package is installed; servers
+that do not speak it are talked to over HTTP/1.1 as before. httpx itself
+is imported on the first request, keeping it off the startup path.
+"""
+import asyncio
+import atexit
+import importlib.util
+import os
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+MAX_CONNECTIONS = int(os.getenv("TNKOS_HTTP_MAX_CONNECTIONS", "10"))
+MAX_KEEPALIVE = int(os.getenv("TNKOS_HTTP_MAX_KEEPALIVE", "5"))
+# Seconds an idle connection is kept before it is closed
+KEEPALIVE_EXPIRY = float(os.getenv("TNKOS_HTTP_KEEPALIVE_EXPIRY", "120"))
+TIMEOUT = 30.0
+HTTP2 = os.getenv("TNKOS_HTTP2", "1") != "0"
+
+_clients = {}
+_lock = threading.Lock()
+# event loop -> {endpoint: AsyncClient}; an AsyncClient only works on the loop it was made on
+_async_clients = weakref.WeakKeyDictionary()
+
+def endpoint(url):
+    """The (scheme, host, port) a url's connections go to."""
+    parts = urlsplit(url)
+    return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+def http2_available():
+    return importlib.util.find_spec("h2") is not None
+
+def client_options():
+    import httpx
+    return {
+        "http2": HTTP2 and http2_available(),
+        "limits": httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        "timeout": TIMEOUT,
+    }
+
+def get_client(url):
+    """The shared httpx.Client for url's endpoint, made on first use. Thread-safe."""
+    key = endpoint(url)
+    with _lock:
+        client = _clients.get(key)
+        if client is None or client.is_closed:
+            import httpx
+            client = _clients[key] = httpx.Client(**client_options())
+        return client
+
+def get_async_client(url):
+    """The shared httpx.AsyncClient for url's endpoint on the running event loop."""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = endpoint(url)
+    client = clients.get(key)
+    if client is None or client.is_closed:
+        import httpx
+        client = clients[key] = httpx.AsyncClient(**client_options())
+    return client
+
+async def aclose_clients():
+    """Close the running event loop's async clients."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose()
+
+def close_clients():
+    """Close the pooled sync clients; clients are made again if used afterwards."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+atexit.register(close_clients)
@@ -0,0 +1,118 @@
+"""Background jobs: commands run alongside the foreground one, each with its own output."""
+import asyncio
+import os
+import re
+import signal
+import time
+
+from .runner import CommandRunner
+from .trace import span
+
+# Background jobs running at once; more wait in the queue for a free slot
+MAX_JOBS = int(os.getenv("TNKOS_MAX_JOBS", "4"))
+JOB_SPEC = re.compile(r"%(\d+)$")
+
+def background_command(command):
+    """command without its trailing "&" when it asks to run in the background, else None."""
+    command = command.rstrip()
+    if not command.endswith("&") or command.endswith(("&&", "|&", ">&", "\\&")):
+        return None
+    return command[:-1].rstrip() or None
+
+def job_spec(word):
+    """The job id in a "%N" job spec, else None."""
+    match = JOB_SPEC.match(word)
+    return int(match.group(1)) if match else None
+
+class Job:
+    """A background command, its state and its own runner.
+
+    status goes "queued", "running", then "done" (exit status 0), "failed"
+    or "killed".
+    """
+
+    def __init__(self, id, command, cwd, write, env=None):
+        self.id = id
+        self.command = command
+        self.cwd = cwd
+        self.runner = CommandRunner(write, cwd, env=env)
+        self.status = "queued"
+        self.returncode = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    @property
+    def runtime(self):
+        """Seconds the job has been running, or ran for."""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+class JobManager:
+    """Runs background jobs, at most limit of them at a time.
+
+    add() creates a job and run() waits for a free slot, then runs it to
+    completion; jobs beyond the limit stay "queued" until one finishes.
+    Jobs run through the default shell with the session's working
+    directory and the environment passed to add(), each as its own process
+    group so it can be signalled alone.
+    """
+
+    def __init__(self, limit=MAX_JOBS):
+        self.limit = limit
+        self.jobs = {}
+        self.next_id = 1
+        self.slots = asyncio.Semaphore(limit)
+
+    def __iter__(self):
+        return iter(self.jobs.values())
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    @property
+    def running(self):
+        return sum(job.status == "running" for job in self)
+
+    def add(self, command, cwd, write, env=None):
+        job = self.jobs[self.next_id] = Job(self.next_id, command, cwd, write, env)
+        self.next_id += 1
+        return job
+
+    async def run(self, job):
+        """Run job once a slot is free; its exit status, None when killed while queued."""
+        async with self.slots:
+            if job.status != "queued":
+                return job.returncode
+            job.status = "running"
+            job.started = time.monotonic()
+            try:
+                with span("job.run", job=job.id) as args:
+                    job.returncode = args["returncode"] = await job.runner.run(job.command)
+            finally:
+                job.finished = time.monotonic()
+                if job.status == "running":
+                    job.status = "done" if job.returncode == 0 else "failed"
+        return job.returncode
+
+    def kill(self, job_id, sig=signal.SIGTERM):
+        """Signal a running job, or drop a queued one; False when there is no such active job."""
+        job = self.jobs.get(job_id)
+        if job is None or not job.active:
+            return False
+        if job.status == "queued":
+            job.status = "killed"
+            return True
+        if sig in (signal.SIGTERM, signal.SIGKILL, signal.SIGHUP):
+            job.status = "killed"
+        return job.runner.interrupt(sig)
+
+    def close(self):
+        for job in self:
+            if job.active:
+                job.status = "killed"
+                job.runner.close()
@@ -1,7 +1,16 @@
+import asyncio
 import os
-import json
-import httpx
-from typing import Dict, List, Union, Generator
+from contextlib import aclosing, closing
+from typing import AsyncGenerator, Dict, List, Generator
+
+from .http_pool import get_async_client, get_client
+from .llm_cache import cache_key, default_cache
+from .singleflight import SingleFlight
+from .sse import DELTAS, SSEDecoder, StreamError, StreamMeter
+from .trace import span, traced
+
+# Identical requests in flight at once, from any LLM instance, share one upstream request
+flights = SingleFlight()
 
 class LLM:
     DEFAULT_MODEL = os.getenv("TNKOS_MODEL", "llama3.2:3b-instruct-fp16")
@@ -11,65 +20,164 @@ class LLM:
     OPENAI_API_URL = os.getenv("TNKOS_URL", "http://localhost:11434/v1")
     ANTHROPIC_API_URL = "https://api.anthropic.com/v1/messages"
 
-    def __init__(self):
+    def __init__(self, cache=True):
         self.prompts = {}
         self.OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
         self.ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
+        # Responses are looked up here first: the shared on-disk cache by
+        # default, a ResponseCache of the caller's, or none for False
+        self.cache = default_cache() if cache is True else (cache or None)
+
 
+    def prompt_call(self, prompt_name: str, cache: bool = True, **kwargs) -> str:
+        prompt = self.get_prompt(prompt_name)
+        formatted_prompt = prompt.format(**kwargs)
+        messages = [{"role": "user", "content": formatted_prompt}]
+        return self.llm_call(messages, cache=cache, prompt_name=prompt_name)
+
+    def prompt_stream(self, prompt_name: str, cache: bool = True, **kwargs) -> Generator[str, None, None]:
+        prompt = self.get_prompt(prompt_name)
+        formatted_prompt = prompt.format(**kwargs)
+        messages = [{"role": "user", "content": formatted_prompt}]
+        return self.llm_stream(messages, cache=cache, prompt_name=prompt_name)
 
-    def prompt_call(self, prompt_name: str, **kwargs) -> str:
+    async def aprompt_call(self, prompt_name: str, cache: bool = True, **kwargs) -> str:
         prompt = self.get_prompt(prompt_name)
         formatted_prompt = prompt.format(**kwargs)
         messages = [{"role": "user", "content": formatted_prompt}]
-        return self.llm_call(messages)
+        return await self.allm_call(messages, cache=cache, prompt_name=prompt_name)
 
-    def prompt_stream(self, prompt_name: str, **kwargs) -> Generator[str, None, None]:
+    def aprompt_stream(self, prompt_name: str, cache: bool = True, **kwargs) -> AsyncGenerator[str, None]:
         prompt = self.get_prompt(prompt_name)
         formatted_prompt = prompt.format(**kwargs)
         messages = [{"role": "user", "content": formatted_prompt}]
-        return self.llm_stream(messages)
-
-    def llm_call(self, messages: List[Dict[str, str]], options: Dict = {}) -> str:
-        options["stream"] = False
-        options.setdefault("model", self.DEFAULT_ANTHROPIC_MODEL if options.get("anthropic", False) else self.DEFAULT_MODEL)
-        try:
-            del options["anthropic"]
-        except:
-            pass
-        if options["model"].startswith("claude-"): 
-            return self._anthropic_call(messages, options)
+        return self.allm_stream(messages, cache=cache, prompt_name=prompt_name)
+
+    @traced("llm.call")
+    def llm_call(self, messages: List[Dict[str, str]], options: Dict = None, cache: bool = True, prompt_name: str = None) -> str:
+        options = self._options(options, stream=False)
+        key = self._request_key(prompt_name, messages, options)
+        store_key = key if cache and self.cache is not None else None
+        response = self._cached(store_key)
+        if response is not None:
+            return response
+        return flights.call(key, lambda: self._call(messages, options, store_key, prompt_name))
+
+    def llm_stream(self, messages: List[Dict[str, str]], options: Dict = None, cache: bool = True, prompt_name: str = None) -> Generator[str, None, None]:
+        options = self._options(options, stream=True)
+        key = self._request_key(prompt_name, messages, options)
+        store_key = key if cache and self.cache is not None else None
+        response = self._cached(store_key)
+        if response is not None:
+            return iter((response,))
+        if options["model"].startswith("claude-"):
+            stream = self._anthropic_stream(messages, options)
         else:
-            return self._openai_call(messages, options)
-
-    def llm_stream(self, messages: List[Dict[str, str]], options: Dict = {}) -> Generator[str, None, None]:
-        options["stream"] = True
-        options.setdefault("model", self.DEFAULT_ANTHROPIC_MODEL if options.get("anthropic", False) else self.DEFAULT_MODEL)
-        try:
-            del options["anthropic"]
-        except:
-            pass
-        if self.DEFAULT_MODEL.startswith("claude-"):
-            return self._anthropic_stream(messages, options)
+            stream = self._openai_stream(messages, options)
+        return self._storing_stream(stream, store_key, prompt_name, options) if store_key else stream
+
+    @traced("llm.acall")
+    async def allm_call(self, messages: List[Dict[str, str]], options: Dict = None, cache: bool = True, prompt_name: str = None) -> str:
+        """llm_call without blocking the event loop."""
+        options = self._options(options, stream=False)
+        key = self._request_key(prompt_name, messages, options)
+        store_key = key if cache and self.cache is not None else None
+        response = await self._acached(store_key)
+        if response is not None:
+            return response
+        return await flights.acall(key, lambda: self._acall(messages, options, store_key, prompt_name))
+
+    def allm_stream(self, messages: List[Dict[str, str]], options: Dict = None, cache: bool = True, prompt_name: str = None) -> AsyncGenerator[str, None]:
+        """llm_stream without blocking the event loop."""
+        options = self._options(options, stream=True)
+        key = self._request_key(prompt_name, messages, options)
+        store_key = key if cache and self.cache is not None else None
+        return self._astream_cached(key, store_key, lambda: self._astream(messages, options, store_key, prompt_name))
+
+    def _call(self, messages, options, store_key, prompt_name):
+        if options["model"].startswith("claude-"):
+            response = self._anthropic_call(messages, options)
         else:
-            return self._openai_stream(messages, options)
-    
-    def _openai_call(self, messages: List[Dict[str, str]], options: Dict) -> str:
-        headers = {
-            "Content-Type": "application/json",
-        }
-        if self.OPENAI_API_KEY:
-            headers["Authorization"] = f"Bearer {self.OPENAI_API_KEY}"
+            response = self._openai_call(messages, options)
+        self._store(store_key, response, prompt_name, options)
+        return response
 
-        data = {
-            "messages": messages,
-            **options
-        }
-        with httpx.Client() as client:
-            response = client.post(self.OPENAI_API_URL+"/chat/completions", headers=headers, json=data, timeout=30.0)
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
+    async def _acall(self, messages, options, store_key, prompt_name):
+        if options["model"].startswith("claude-"):
+            response = await self._aanthropic_call(messages, options)
+        else:
+            response = await self._aopenai_call(messages, options)
+        await self._astore(store_key, response, prompt_name, options)
+        return response
 
-    def _openai_stream(self, messages: List[Dict[str, str]], options: Dict) -> Generator[str, None, None]:
+    def _astream(self, messages, options, store_key, prompt_name):
+        if options["model"].startswith("claude-"):
+            stream = self._aanthropic_stream(messages, options)
+        else:
+            stream = self._aopenai_stream(messages, options)
+        return self._astoring_stream(stream, store_key, prompt_name, options) if store_key else stream
+
+    def _request_key(self, prompt_name, messages, options):
+        # Identifies a request, for the cache and for coalescing identical ones in flight
+        endpoint = self.ANTHROPIC_API_URL if options["model"].startswith("claude-") else self.OPENAI_API_URL
+        # Streamed or not, the response is the same
+        options = {key: value for key, value in options.items() if key != "stream"}
+        return cache_key(prompt_name, messages, options, endpoint)
+
+    def _cached(self, key):
+        if key is None:
+            return None
+        with span("llm.cache") as args:
+            response = self.cache.get(key)
+            args["hit"] = response is not None
+        return response
+
+    async def _acached(self, key):
+        # SQLite can wait seconds for another process's lock; not on the event loop
+        if key is None:
+            return None
+        return await asyncio.to_thread(self._cached, key)
+
+    async def _astream_cached(self, key, store_key, upstream):
+        response = await self._acached(store_key)
+        stream = _async_chunks(response) if response is not None else flights.astream(key, upstream)
+        async with aclosing(stream):
+            async for chunk in stream:
+                yield chunk
+
+    def _store(self, key, response, prompt_name, options):
+        if key is not None and response is not None:
+            self.cache.set(key, response, prompt_name, options.get("model"))
+
+    async def _astore(self, key, response, prompt_name, options):
+        if key is not None and response is not None:
+            await asyncio.to_thread(self._store, key, response, prompt_name, options)
+
+    def _storing_stream(self, stream, key, prompt_name, options):
+        # Passes chunks through; only a stream read to the end is cached
+        chunks = []
+        with closing(stream):
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        self._store(key, "".join(chunks), prompt_name, options)
+
+    async def _astoring_stream(self, stream, key, prompt_name, options):
+        chunks = []
+        async with aclosing(stream):
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        await self._astore(key, "".join(chunks), prompt_name, options)
+
+    def _options(self, options, stream):
+        # A copy: callers' dicts (and the defaults) are not changed
+        options = dict(options or {}, stream=stream)
+        anthropic = options.pop("anthropic", False)
+        options.setdefault("model", self.DEFAULT_ANTHROPIC_MODEL if anthropic else self.DEFAULT_MODEL)
+        return options
+
+    def _openai_request(self, messages: List[Dict[str, str]], options: Dict):
         headers = {
             "Content-Type": "application/json",
         }
@@ -78,19 +186,11 @@ class LLM:
 
         data = {
             "messages": messages,
-            "stream": True,
             **options
         }
-        with httpx.Client() as client:
-            with client.stream("POST", self.OPENAI_API_URL+"/chat/completions", headers=headers, json=data) as response:
-                for line in response.iter_lines():
-                    if line.startswith("data: "):
-                        json_line = json.loads(line[6:])
-                        if json_line["choices"][0]["finish_reason"] is not None:
-                            break
-                        yield json_line["choices"][0]["delta"].get("content", "")
+        return self.OPENAI_API_URL+"/chat/completions", headers, data
 
-    def _anthropic_call(self, messages: List[Dict[str, str]], options: Dict) -> str:
+    def _anthropic_request(self, messages: List[Dict[str, str]], options: Dict):
         headers = {
             "Content-Type": "application/json",
             "anthropic-version": "2023-06-01",
@@ -101,33 +201,84 @@ class LLM:
             "max_tokens": options.get("max_tokens", 1000),
             **options
         }
-        with httpx.Client() as client:
-            response = client.post(self.ANTHROPIC_API_URL, headers=headers, json=data, timeout=30.0)
+        return self.ANTHROPIC_API_URL, headers, data
+
+    def _openai_call(self, messages: List[Dict[str, str]], options: Dict) -> str:
+        url, headers, data = self._openai_request(messages, options)
+        client = get_client(url)
+        with span("llm.http", api="openai", model=options.get("model")):
+            response = client.post(url, headers=headers, json=data, timeout=30.0)
+            response.raise_for_status()
+            return response.json()["choices"][0]["message"]["content"]
+
+    def _openai_stream(self, messages: List[Dict[str, str]], options: Dict) -> Generator[str, None, None]:
+        url, headers, data = self._openai_request(messages, options)
+        return self._sse_stream("openai", url, headers, data)
+
+    def _anthropic_call(self, messages: List[Dict[str, str]], options: Dict) -> str:
+        url, headers, data = self._anthropic_request(messages, options)
+        client = get_client(url)
+        with span("llm.http", api="anthropic", model=options.get("model")):
+            response = client.post(url, headers=headers, json=data, timeout=30.0)
             response.raise_for_status()
             return response.json()["content"][0]["text"]
 
     def _anthropic_stream(self, messages: List[Dict[str, str]], options: Dict) -> Generator[str, None, None]:
-        headers = {
-            "Content-Type": "application/json",
-            "anthropic-version": "2023-06-01",
-            "X-API-Key": self.ANTHROPIC_API_KEY
-        }
-        data = {
-            "messages": messages,
-            "max_tokens": options.get("max_tokens", 1000),
-            "stream": True,
-            **options
-        }
-        with httpx.Client() as client:
-            with client.stream("POST", self.ANTHROPIC_API_URL, headers=headers, json=data, timeout=30.0) as response:
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            json_line = json.loads(line)
-                            if json_line["event"] == "content_block_delta":
-                                yield json_line["delta"]["text"]
-                        except:
-                            pass
+        url, headers, data = self._anthropic_request(messages, options)
+        return self._sse_stream("anthropic", url, headers, data)
+
+    def _sse_stream(self, api, url, headers, data):
+        # The text of a streamed response, whichever API it comes from
+        client = get_client(url)
+        decoder = SSEDecoder()
+        with span("llm.stream", api=api, model=data.get("model")) as args:
+            meter = StreamMeter(args)
+            with client.stream("POST", url, headers=headers, json=data) as response:
+                response.raise_for_status()
+                for chunk in response.iter_bytes():
+                    for delta in _deltas(api, decoder.feed(chunk), meter):
+                        yield delta.value
+                for delta in _deltas(api, [decoder.flush()], meter):
+                    yield delta.value
+            meter.finish()
+
+    async def _aopenai_call(self, messages: List[Dict[str, str]], options: Dict) -> str:
+        url, headers, data = self._openai_request(messages, options)
+        client = get_async_client(url)
+        with span("llm.http", api="openai", model=options.get("model")):
+            response = await client.post(url, headers=headers, json=data, timeout=30.0)
+            response.raise_for_status()
+            return response.json()["choices"][0]["message"]["content"]
+
+    def _aopenai_stream(self, messages: List[Dict[str, str]], options: Dict) -> AsyncGenerator[str, None]:
+        url, headers, data = self._openai_request(messages, options)
+        return self._asse_stream("openai", url, headers, data)
+
+    async def _aanthropic_call(self, messages: List[Dict[str, str]], options: Dict) -> str:
+        url, headers, data = self._anthropic_request(messages, options)
+        client = get_async_client(url)
+        with span("llm.http", api="anthropic", model=options.get("model")):
+            response = await client.post(url, headers=headers, json=data, timeout=30.0)
+            response.raise_for_status()
+            return response.json()["content"][0]["text"]
+
+    def _aanthropic_stream(self, messages: List[Dict[str, str]], options: Dict) -> AsyncGenerator[str, None]:
+        url, headers, data = self._anthropic_request(messages, options)
+        return self._asse_stream("anthropic", url, headers, data)
+
+    async def _asse_stream(self, api, url, headers, data):
+        client = get_async_client(url)
+        decoder = SSEDecoder()
+        with span("llm.stream", api=api, model=data.get("model")) as args:
+            meter = StreamMeter(args)
+            async with client.stream("POST", url, headers=headers, json=data) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    for delta in _deltas(api, decoder.feed(chunk), meter):
+                        yield delta.value
+                for delta in _deltas(api, [decoder.flush()], meter):
+                    yield delta.value
+            meter.finish()
 
     def get_prompt(self, prompt_name: str) -> str:
         if prompt_name not in self.prompts:
@@ -135,3 +286,21 @@ class LLM:
             with open(prompt_path, "r") as f:
                 self.prompts[prompt_name] = f.read().strip()
         return self.prompts[prompt_name]
+
+async def _async_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+def _deltas(api, events, meter):
+    # The text deltas in events, metering every delta on the way; the
+    # stream is read to its end, so its connection goes back to the pool
+    parse = DELTAS[api]
+    for event in events:
+        if event is None:
+            continue
+        for delta in parse(event):
+            meter.add(delta)
+            if delta.type == "text":
+                yield delta
+            elif delta.type == "error":
+                raise StreamError(delta.value)
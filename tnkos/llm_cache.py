@@ -0,0 +1,156 @@
+"""On-disk cache of LLM responses, shared by every tool and process.
+
+Responses are stored in a SQLite file keyed by a hash of the prompt
+name, the messages, the model, the sampling options and the endpoint.
+Entries expire after ttl seconds, and the least recently used ones are
+evicted once the cache holds more than max_entries of them or
+max_bytes of text; an entry's last access is only updated once per
+TOUCH_INTERVAL, so most hits are plain reads that take no lock.
+
+The database runs in WAL mode with a busy timeout, so several tnkos
+processes can read and write it at once; each thread gets its own
+connection.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CACHE_FILE = Path(os.getenv(
+    "TNKOS_LLM_CACHE_FILE",
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "tnkos" / "llm_cache.sqlite3",
+))
+CACHE_TTL = float(os.getenv("TNKOS_LLM_CACHE_TTL", 7 * 24 * 3600))
+CACHE_MAX_ENTRIES = int(os.getenv("TNKOS_LLM_CACHE_MAX_ENTRIES", 10_000))
+CACHE_MAX_BYTES = int(os.getenv("TNKOS_LLM_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_ENABLED = os.getenv("TNKOS_LLM_CACHE", "1") != "0"
+# Milliseconds a writer waits for another process's lock before giving up
+BUSY_TIMEOUT = 5000
+# Seconds between updates of an entry's last access: hits within it only read
+TOUCH_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    prompt_name TEXT,
+    model TEXT,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+def cache_key(prompt_name, messages, options, endpoint):
+    """Stable hash of everything that decides a response."""
+    payload = json.dumps(
+        {"prompt": prompt_name, "messages": messages, "options": options, "endpoint": endpoint},
+        sort_keys=True, default=repr,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ResponseCache:
+    def __init__(self, path=CACHE_FILE, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT / 1000, isolation_level=None)
+            conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+            conn.execute("PRAGMA journal_mode = WAL")
+            # WAL commits without an fsync; a crash can lose the last few entries, never corrupt them
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        """The cached response for key, or None when missing or expired.
+
+        May wait for another process's write lock when the entry has
+        expired; call it off the event loop.
+        """
+        try:
+            conn = self._connect()
+            row = conn.execute("SELECT response, created, accessed FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, created, accessed = row
+            now = time.time()
+            if now - created > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            if now - accessed > TOUCH_INTERVAL:
+                self._touch(conn, key, now)
+            return response
+        except sqlite3.Error:
+            # A cache that cannot be read is a cache miss
+            return None
+
+    def _touch(self, conn, key, now):
+        # Best effort: while another process writes, the touch is skipped rather than waited for
+        conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+
+    def set(self, key, response, prompt_name=None, model=None):
+        try:
+            conn = self._connect()
+            now = time.time()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, prompt_name, model, response, size, created, accessed)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, prompt_name, model, response, len(response.encode()), now, now))
+                self._evict(conn, now)
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        # Keep the most recently used entries within both limits
+        conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            " SELECT key FROM (SELECT key, ROW_NUMBER() OVER win AS n, SUM(size) OVER win AS total"
+            "  FROM responses WINDOW win AS (ORDER BY accessed DESC))"
+            " WHERE n > ? OR total > ?)",
+            (self.max_entries, self.max_bytes))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+_default_cache = None
+
+def default_cache():
+    """The process-wide ResponseCache, or None when caching is turned off."""
+    global _default_cache
+    if not CACHE_ENABLED:
+        return None
+    if _default_cache is None:
+        _default_cache = ResponseCache()
+    return _default_cache
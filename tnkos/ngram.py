@@ -0,0 +1,75 @@
+import numpy as np
+
+from .fuzzy import is_ascii
+
+# Above this share of the corpus, a posting is not worth intersecting: scan every line instead
+MAX_SELECTIVITY = 0.5
+
+class NgramIndex:
+    """Inverted index over a Corpus from grams to the lines containing them.
+
+    A gram is a char with a multiplicity: ("g", 2) is every line holding at
+    least two g's. Any line a fuzzy pattern matches contains each pattern
+    char at least as often as the pattern does, so intersecting the postings
+    of the pattern's grams gives a candidate set without false negatives.
+    Contiguous bigrams/trigrams would not: "gco" matches "git checkout".
+
+    Postings are sorted arrays of line ids, built on first use from the
+    corpus' occurrence lists and appended to when the corpus is extended.
+    A query intersects them smallest first, probing each larger posting
+    with a binary search per surviving candidate, so its cost follows the
+    rarest gram of the pattern rather than the size of the corpus.
+    """
+
+    def __init__(self, corpus, case_sensitive=False):
+        self.corpus = corpus
+        self.case_sensitive = case_sensitive
+        self.size = len(corpus)
+        self.postings = {}
+
+    def grams(self, pattern):
+        counts = {}
+        for pchar in pattern:
+            counts[pchar] = counts.get(pchar, 0) + 1
+        return [(ord(pchar), count) for pchar, count in counts.items()]
+
+    def _lines_with(self, code, count, start=0):
+        # Sorted ids of the lines from start on holding code at least count times
+        corpus = self.corpus
+        occ = corpus.occurrences(code, self.case_sensitive)
+        if start:
+            occ = occ[np.searchsorted(occ, corpus.starts[start]):] if start < len(corpus) else occ[:0]
+        lines, counts = np.unique(np.searchsorted(corpus.ends, occ, side="right"), return_counts=True)
+        return (lines if count == 1 else lines[counts >= count]).astype(np.int64)
+
+    def posting(self, code, count):
+        key = (code, count)
+        if key not in self.postings:
+            self.postings[key] = self._lines_with(code, count)
+        return self.postings[key]
+
+    def extend(self):
+        """Index the lines appended to the corpus since the last call."""
+        start = self.size
+        self.size = len(self.corpus)
+        if start == self.size:
+            return
+        for (code, count), posting in self.postings.items():
+            self.postings[code, count] = np.concatenate((posting, self._lines_with(code, count, start)))
+
+    def candidates(self, pattern):
+        """Sorted indices of the lines that can match pattern, or None to scan them all."""
+        if len(pattern) == 0:
+            return None
+        if not is_ascii(pattern):
+            return np.arange(0)
+        postings = sorted((self.posting(code, count) for code, count in self.grams(pattern)), key=len)
+        if len(postings[0]) > MAX_SELECTIVITY * self.size:
+            return None
+        candidates = postings[0]
+        for posting in postings[1:]:
+            if len(candidates) == 0:
+                break
+            found = posting[np.minimum(np.searchsorted(posting, candidates), len(posting) - 1)] == candidates
+            candidates = candidates[found]
+        return candidates
@@ -0,0 +1,394 @@
+import hashlib
+import mmap
+import os
+import queue
+import re
+import shlex
+import tempfile
+from array import array
+from bisect import bisect_right
+from collections import deque
+from functools import lru_cache
+
+from rich.console import Console
+from rich.control import strip_control_codes
+from rich.highlighter import ReprHighlighter
+from rich.style import Style
+from rich.text import Span, Text
+from textual.cache import LRUCache
+from textual.geometry import Size
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
+from textual.worker import get_current_worker
+
+# Rows kept in memory, by count and by total chars; older ones go to disk
+MEMORY_ROWS = 10_000
+MEMORY_CHARS = 4 * 1024 * 1024
+SPILL_BATCH = 1024
+# Spilled rows get a byte offset every BLOCK_ROWS rows
+BLOCK_ROWS = 128
+# Rows are hard-wrapped at this length when the widget width is not known yet
+MAX_ROW = 4096
+# Syntax highlighting works on blocks of this many rows of one command's output
+HIGHLIGHT_BLOCK = 64
+HIGHLIGHT_THEME = "monokai"
+SHELL_OPERATORS = {"|", "||", "&&", ";", "&", ">", ">>", "<"}
+PAGERS = {"cat", "bat", "head", "tail", "less", "more"}
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)")
+
+_ansi_console = Console(color_system="truecolor", force_terminal=True, width=MAX_ROW)
+
+def to_ansi(text):
+    """A Text as a str with SGR escapes, so styled rows store like command output."""
+    options = _ansi_console.options.update(width=max(text.cell_len, 1), no_wrap=True, overflow="ignore", highlight=False)
+    return "".join(
+        segment.style.render(segment.text) if segment.style else segment.text
+        for segment in _ansi_console.render(text, options)
+        if not segment.control
+    ).rstrip("\n")
+
+def output_lexer(command):
+    """Pygments lexer for what command prints, or None to leave its output plain."""
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return None
+    # Only the first simple command says what the output is
+    for index, word in enumerate(words):
+        if word in SHELL_OPERATORS:
+            words = words[:index]
+            break
+    if not words:
+        return None
+    name = os.path.basename(words[0])
+    if name == "diff" or (name == "git" and len(words) > 1 and words[1] in ("diff", "show")):
+        return "diff"
+    if name == "jq":
+        return "json"
+    if name in PAGERS:
+        files = [word for word in words[1:] if not word.startswith("-")]
+        if files:
+            # pygments scans its plugins on import; not something startup should wait on
+            from pygments.lexers import get_lexer_for_filename
+            from pygments.util import ClassNotFound
+            try:
+                return get_lexer_for_filename(files[-1]).aliases[0]
+            except ClassNotFound:
+                return None
+    return None
+
+@lru_cache(maxsize=None)
+def _foreground(style):
+    return Style(color=style.color, bold=style.bold, italic=style.italic, underline=style.underline)
+
+def highlight_block(lexer, rows):
+    """One Text per row, the rows tokenized together; rows with escapes are left out."""
+    from rich.syntax import Syntax
+    code = "\n".join("" if "\x1b" in row else row for row in rows)
+    lines = Syntax(code, lexer, theme=HIGHLIGHT_THEME).highlight(code).split("\n", allow_blank=True)
+    for line in lines:
+        # Token colours only; the log keeps its own background
+        line.style = ""
+        line.end = ""
+        line.spans = [Span(span.start, span.end, _foreground(span.style)) for span in line.spans]
+    return (list(lines) + [Text("")] * len(rows))[:len(rows)]
+
+class OutputBuffer:
+    """Append-only rows of output, bounded in memory.
+
+    The newest rows stay in a deque. Once there are more than max_rows of
+    them, or more than max_chars, the oldest are appended to an unlinked
+    temp file and read back through an mmap when scrolled to. Locating a
+    spilled row costs a sparse offset table (one entry per BLOCK_ROWS rows)
+    plus a few newline searches, so memory stays flat however much a
+    command prints.
+    """
+
+    def __init__(self, max_rows=MEMORY_ROWS, max_chars=MEMORY_CHARS):
+        self.max_rows = max_rows
+        self.max_chars = max_chars
+        self.recent = deque()
+        self.recent_chars = 0
+        self.spilled = 0
+        self.blocks = array("Q")
+        self.file = None
+        self.size = 0
+        self.map = None
+        # (row, offset just past it) of the last spilled read, for scrolling
+        self.cursor = None
+
+    def __len__(self):
+        return self.spilled + len(self.recent)
+
+    def extend(self, rows):
+        for row in rows:
+            self.recent.append(row)
+            self.recent_chars += len(row)
+        if len(self.recent) > self.max_rows + SPILL_BATCH or self.recent_chars > self.max_chars:
+            self._spill()
+
+    def _spill(self):
+        rows = []
+        while self.recent and (len(self.recent) > self.max_rows or self.recent_chars > self.max_chars):
+            row = self.recent.popleft()
+            self.recent_chars -= len(row)
+            rows.append(row)
+        if not rows:
+            return
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix="tnkos-output-")
+        chunk = []
+        for row in rows:
+            if self.spilled % BLOCK_ROWS == 0:
+                self.blocks.append(self.size)
+            data = row.encode("utf-8", errors="replace") + b"\n"
+            chunk.append(data)
+            self.size += len(data)
+            self.spilled += 1
+        self.file.write(b"".join(chunk))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index >= self.spilled:
+            return self.recent[index - self.spilled]
+        return self._read_spilled(index)
+
+    def _read_spilled(self, index):
+        if self.map is None or len(self.map) < self.size:
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        buf = self.map
+        if self.cursor is not None and self.cursor[0] < index and index - self.cursor[0] <= index % BLOCK_ROWS:
+            row, start = self.cursor[0] + 1, self.cursor[1]
+        else:
+            row, start = index - index % BLOCK_ROWS, self.blocks[index // BLOCK_ROWS]
+        while row < index:
+            start = buf.find(b"\n", start) + 1
+            row += 1
+        end = buf.find(b"\n", start)
+        self.cursor = (index, end + 1)
+        return buf[start:end].decode("utf-8", errors="replace")
+
+    def clear(self):
+        self.close()
+        self.recent.clear()
+        self.recent_chars = 0
+        self.spilled = 0
+        self.blocks = array("Q")
+        self.size = 0
+
+    def close(self):
+        self.cursor = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class OutputLog(ScrollView):
+    """Scrollback for command output, backed by an OutputBuffer.
+
+    Takes str (raw command output, which may hold ANSI colours) or rich
+    Text like RichLog.write, hard-wraps it to the width at the time of the
+    write, and renders only the rows in view.
+
+    Output written after set_lexer(name) is syntax highlighted. Rows in view
+    are grouped into blocks of HIGHLIGHT_BLOCK rows of one command's output;
+    each block is tokenized by a background thread, newest request first,
+    and the result cached by a hash of the block's content. Until a block
+    is done its rows show with the plain highlighter.
+    """
+
+    DEFAULT_CSS = """
+    OutputLog {
+        background: $surface;
+        color: $foreground;
+        overflow-y: scroll;
+        overflow-x: auto;
+    }
+    """
+
+    def __init__(self, *args, highlight=True, max_rows=MEMORY_ROWS, max_chars=MEMORY_CHARS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer = OutputBuffer(max_rows, max_chars)
+        self.highlight = highlight
+        self.highlighter = ReprHighlighter()
+        self.auto_scroll = True
+        self.widest = 0
+        self._line_cache = LRUCache(1024)
+        # Row where each lexer's output starts, and the lexer (None: plain)
+        self.lexer_starts = [0]
+        self.lexers = [None]
+        self._block_digests = LRUCache(1024)
+        self._highlights = LRUCache(256)
+        self._pending = set()
+        self._requests = queue.LifoQueue()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    @property
+    def lines(self):
+        """The plain text of every row, oldest first."""
+        return [ANSI_ESCAPE.sub("", self.buffer[i]) for i in range(len(self.buffer))]
+
+    def notify_style_update(self):
+        super().notify_style_update()
+        self._line_cache.clear()
+
+    def write(self, content, scroll_end=None):
+        if isinstance(content, Text):
+            content = to_ansi(content)
+        width = self.scrollable_content_region.width or MAX_ROW
+        rows = []
+        for line in content.expandtabs().split("\n"):
+            rows.extend(wrap_row(clean_line(line), width))
+        self.buffer.extend(rows)
+        self.widest = max(self.widest, max(map(row_width, rows)))
+
+        # Only follow the output if the view was already at the bottom
+        follow = (self.auto_scroll if scroll_end is None else scroll_end) and self.scroll_offset.y >= self.max_scroll_y
+        self.virtual_size = Size(self.widest, len(self.buffer))
+        if follow:
+            self.scroll_end(animate=False, immediate=False, x_axis=False)
+        self.refresh()
+        return self
+
+    def set_lexer(self, lexer):
+        """Highlight what is written from now on with lexer (None for plain)."""
+        start = len(self.buffer)
+        if self.lexer_starts[-1] == start:
+            self.lexers[-1] = lexer
+        else:
+            self.lexer_starts.append(start)
+            self.lexers.append(lexer)
+
+    def clear(self):
+        self.buffer.clear()
+        self._line_cache.clear()
+        self._block_digests.clear()
+        self.lexer_starts = [0]
+        self.lexers = [None]
+        self.widest = 0
+        self.virtual_size = Size(0, 0)
+        self.refresh()
+        return self
+
+    def on_mount(self):
+        self.run_worker(self._highlight_blocks, thread=True, group="highlight", exit_on_error=False)
+
+    def on_unmount(self):
+        self._requests.put(None)
+        self.buffer.close()
+
+    def render_line(self, y):
+        scroll_x, scroll_y = self.scroll_offset
+        width = self.scrollable_content_region.width
+        index = scroll_y + y
+        if index >= len(self.buffer):
+            return Strip.blank(width, self.rich_style)
+        row = self.buffer[index]
+        highlighted = self._highlighted_row(index, row)
+        key = (index, scroll_x, width, highlighted is not None)
+        if key not in self._line_cache:
+            text = highlighted if highlighted is not None else self.render_row(row)
+            strip = Strip(text.render(self.app.console, end=""))
+            self._line_cache[key] = strip.crop_extend(scroll_x, scroll_x + width, self.rich_style)
+        return self._line_cache[key].apply_style(self.rich_style)
+
+    def render_row(self, row):
+        if "\x1b" in row:
+            return Text.from_ansi(row, end="")
+        text = Text(row, end="")
+        return self.highlighter(text) if self.highlight else text
+
+    def _block_at(self, index):
+        # (start, end, lexer) of the highlight block holding row index
+        segment = bisect_right(self.lexer_starts, index) - 1
+        lexer = self.lexers[segment]
+        if lexer is None:
+            return None
+        segment_start = self.lexer_starts[segment]
+        segment_end = self.lexer_starts[segment + 1] if segment + 1 < len(self.lexer_starts) else len(self.buffer)
+        start = segment_start + (index - segment_start) // HIGHLIGHT_BLOCK * HIGHLIGHT_BLOCK
+        return start, min(start + HIGHLIGHT_BLOCK, segment_end), lexer
+
+    def _highlighted_row(self, index, row):
+        if not self.highlight or "\x1b" in row:
+            return None
+        block = self._block_at(index)
+        if block is None:
+            return None
+        lines = self._highlights.get(self._block_digest(block))
+        if lines is not None:
+            return lines[index - block[0]]
+        self._request(block)
+        # Get the blocks either side of the view going too
+        for neighbour in (block[0] - 1, block[1]):
+            if 0 <= neighbour < len(self.buffer):
+                nearby = self._block_at(neighbour)
+                if nearby is not None:
+                    self._request(nearby)
+        return None
+
+    def _block_digest(self, block):
+        # Rows never change once written, so a block's position and extent fix its content
+        digest = self._block_digests.get(block)
+        if digest is None:
+            start, end, lexer = block
+            content = "\n".join([lexer] + [self.buffer[i] for i in range(start, end)])
+            digest = self._block_digests[block] = hashlib.blake2b(content.encode(errors="replace"), digest_size=16).digest()
+        return digest
+
+    def _request(self, block):
+        digest = self._block_digest(block)
+        if digest in self._pending or self._highlights.get(digest) is not None:
+            return
+        start, end, lexer = block
+        self._pending.add(digest)
+        self._requests.put((digest, lexer, [self.buffer[i] for i in range(start, end)]))
+
+    def _highlight_blocks(self):
+        # Worker thread: tokenize requested blocks, the most recently asked for first
+        worker = get_current_worker()
+        while not worker.is_cancelled:
+            request = self._requests.get()
+            if request is None:
+                return
+            digest, lexer, rows = request
+            try:
+                lines = highlight_block(lexer, rows)
+            except Exception:
+                lines = [self.render_row(row) for row in rows]
+            self.app.call_from_thread(self._store_highlight, digest, lines)
+
+    def _store_highlight(self, digest, lines):
+        self._pending.discard(digest)
+        self._highlights[digest] = lines
+        self.refresh()
+
+def clean_line(line):
+    # A carriage return redraws the line (progress bars); keep what would show last
+    line = line.rstrip("\r")
+    if "\r" in line:
+        line = line.rsplit("\r", 1)[1]
+    return strip_control_codes(line)
+
+def row_width(row):
+    return len(ANSI_ESCAPE.sub("", row)) if "\x1b" in row else len(row)
+
+def wrap_row(line, width):
+    """line split into rows of at most width chars (escape codes count towards plain rows only)."""
+    if len(line) <= width:
+        return [line]
+    if "\x1b" not in line:
+        return [line[i:i + width] for i in range(0, len(line), width)]
+    if row_width(line) <= width:
+        return [line]
+    text = Text.from_ansi(line, end="")
+    return [to_ansi(part) for part in text.divide(range(width, len(text), width))]
@@ -0,0 +1,349 @@
+import asyncio
+import codecs
+import fcntl
+import os
+import pty
+import secrets
+import shlex
+import shutil
+import signal
+import struct
+import sys
+import termios
+
+FLUSH_INTERVAL = 0.05
+READ_SIZE = 64 * 1024
+# Decoded chars waiting for a flush before the reader stops draining the pipe
+HIGH_WATER = 1024 * 1024
+PTY_SIZE = (50, 200)
+
+# Makes the pty the shell's controlling terminal before exec'ing it, which
+# subprocess can only do through a preexec_fn, and that is unsafe with threads.
+# Python ignores SIGPIPE, and exec would pass that on to every command.
+CTTY_LAUNCHER = (
+    "import fcntl, os, signal, sys, termios; "
+    "signal.signal(signal.SIGPIPE, signal.SIG_DFL); "
+    "fcntl.ioctl(0, termios.TIOCSCTTY, 0); "
+    "os.execvp(sys.argv[1], sys.argv[1:])"
+)
+
+SHELL_ARGS = {
+    "zsh": ["+Z", "-i"],
+    "bash": ["--noediting", "-i"],
+}
+
+# Sent as one line so the shell reports back once, after running all of it.
+# History goes off first: neither this line nor the eval'd commands belong
+# in the user's history file, and tnkos keeps its own. The hook runs before
+# any of the user's so it sees the command's status.
+PRECMD = "__tnkos_precmd() {{ local s=$?; printf '\\033]777;tnkos;%s;%s;%s\\a' {token} $s \"$PWD\"; return $s; }}"
+SHELL_INIT = {
+    "zsh": "unset HISTFILE; fc -p; unsetopt prompt_cr prompt_sp; PS1= PS2= RPS1= RPROMPT=; stty -echo; " + PRECMD
+           + "; precmd_functions=(__tnkos_precmd $precmd_functions)\n",
+    "bash": "set +o history; unset HISTFILE; history -c; PS1= PS2= PS0=; stty -echo; " + PRECMD
+            + "; PROMPT_COMMAND=\"__tnkos_precmd${{PROMPT_COMMAND:+;$PROMPT_COMMAND}}\"\n",
+}
+
+def find_shell():
+    """Path of the user's shell if it is zsh or bash, else of either; None without one."""
+    for name in (os.environ.get("SHELL"), "zsh", "bash"):
+        if name and os.path.basename(name) in SHELL_ARGS:
+            path = shutil.which(name)
+            if path:
+                return path
+    return None
+
+def command_runner(write, cwd=None):
+    """A ShellSession when a zsh or bash is around, else a CommandRunner."""
+    shell = find_shell()
+    if shell is None:
+        return CommandRunner(write, cwd)
+    return ShellSession(write, shell, cwd)
+
+class CommandRunner:
+    """Runs shell commands as asyncio subprocesses, streaming their output.
+
+    stdout and stderr are merged, decoded incrementally and handed to write()
+    in batches of whole lines at most every flush_interval seconds. Once more
+    than high_water chars are waiting the reader stops draining the pipe
+    until the next flush, so a chatty command blocks on its own writes
+    instead of piling up output in memory. Commands run one at a time,
+    with env as their environment, or the app's when it is None.
+    """
+
+    def __init__(self, write, cwd=None, flush_interval=FLUSH_INTERVAL, high_water=HIGH_WATER, env=None):
+        self.write = write
+        self.cwd = cwd or os.getcwd()
+        self.env = env
+        self.flush_interval = flush_interval
+        self.high_water = high_water
+        self.process = None
+        self.pending = []
+        self.pending_size = 0
+        self.drained = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def run(self, command, cwd=None):
+        """Run command to completion and return its exit code."""
+        async with self.lock:
+            self.cwd = cwd or self.cwd
+            self.process = await asyncio.create_subprocess_shell(
+                command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                cwd=self.cwd,
+                env=self.env,
+                # Own process group, so an interrupt reaches its children too
+                start_new_session=True,
+            )
+            flusher = asyncio.create_task(self._flush_periodically())
+            try:
+                await self._read(self.process.stdout)
+                returncode = await self.process.wait()
+                # Report deaths by signal the way shells do
+                return 128 - returncode if returncode < 0 else returncode
+            finally:
+                flusher.cancel()
+                if self.process.returncode is None:
+                    self._signal(signal.SIGKILL)
+                self.flush(final=True)
+                self.process = None
+
+    def interrupt(self, sig=signal.SIGINT):
+        """Signal the running command; False when there is none."""
+        if not self.running:
+            return False
+        self._signal(sig)
+        return True
+
+    def send(self, text):
+        """Type text into the running command; False when it takes no input."""
+        return False
+
+    def close(self):
+        if self.running:
+            self._signal(signal.SIGKILL)
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    async def _read(self, stream):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while chunk := await stream.read(READ_SIZE):
+            self._queue(decoder.decode(chunk))
+            if self.pending_size > self.high_water:
+                self.drained.clear()
+                await self.drained.wait()
+        self._queue(decoder.decode(b"", final=True))
+
+    def _queue(self, text):
+        if text:
+            self.pending.append(text)
+            self.pending_size += len(text)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self, final=False):
+        """Write out the whole lines waiting (everything, when final)."""
+        text = "".join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        if not final:
+            # Hold back a trailing partial line unless it alone is over the limit
+            cut = text.rfind("\n") + 1
+            if len(text) - cut < self.high_water:
+                self._queue(text[cut:])
+                text = text[:cut]
+        if text:
+            self.write(text[:-1] if text.endswith("\n") else text)
+        self.drained.set()
+
+class ShellSession(CommandRunner):
+    """One long-lived interactive zsh or bash on a pseudo-terminal.
+
+    Commands are written to the shell as if typed, so variables, aliases,
+    functions and the working directory carry over between them. A precmd
+    hook prints an OSC sequence with a per-session token, the exit status
+    and $PWD whenever the shell is back at its prompt; that ends the
+    command's output and is how cwd follows the real shell. The shell is
+    (re)started on demand, e.g. after an "exit".
+    """
+
+    def __init__(self, write, shell=None, cwd=None, flush_interval=FLUSH_INTERVAL, high_water=HIGH_WATER):
+        super().__init__(write, cwd, flush_interval, high_water)
+        self.shell = shell or find_shell()
+        self.token = secrets.token_hex(8)
+        self.marker = f"\x1b]777;tnkos;{self.token};".encode()
+        self.master = None
+        self.reader = None
+        self.pump = None
+        self.sink = None
+        self.done = None
+        self.busy = False
+
+    @property
+    def running(self):
+        return self.busy
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        if self.master is not None:
+            os.close(self.master)
+        master, slave = pty.openpty()
+        attrs = termios.tcgetattr(slave)
+        attrs[1] &= ~termios.ONLCR
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", *PTY_SIZE, 0, 0))
+        # Output lands in a log, not a screen: no pagers or full-screen redraws
+        env = dict(os.environ, TERM="dumb", PAGER="cat", GIT_PAGER="cat")
+        name = os.path.basename(self.shell)
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, "-c", CTTY_LAUNCHER, self.shell, *SHELL_ARGS[name],
+                stdin=slave, stdout=slave, stderr=slave, cwd=self.cwd, env=env, start_new_session=True)
+        finally:
+            os.close(slave)
+        self.master = master
+        self.reader = asyncio.StreamReader()
+        loop = asyncio.get_running_loop()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(self.reader), os.fdopen(os.dup(master), "rb", 0))
+        self.pump = asyncio.create_task(self._pump())
+        # Whatever the rc files and the first prompt print is dropped
+        await self._exchange(SHELL_INIT[name].format(token=self.token), None)
+
+    async def run(self, command, cwd=None):
+        """Run command in the shell and return its exit status."""
+        async with self.lock:
+            if not self.alive:
+                self.cwd = cwd or self.cwd
+                await self.start()
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            self.busy = True
+            flusher = asyncio.create_task(self._flush_periodically())
+            try:
+                return await self._exchange(f"eval {shlex.quote(command)}\n", lambda data: self._queue(decoder.decode(data)))
+            finally:
+                self.busy = False
+                self.sink = None
+                flusher.cancel()
+                self._queue(decoder.decode(b"", final=True))
+                self.flush(final=True)
+
+    async def capture(self, command):
+        """(status, output) of command, without writing the output anywhere."""
+        async with self.lock:
+            if not self.alive:
+                await self.start()
+            chunks = []
+            status = await self._exchange(f"eval {shlex.quote(command)}\n", chunks.append)
+            return status, b"".join(chunks).decode(errors="replace")
+
+    async def environ(self):
+        """The shell's exported environment."""
+        _, output = await self.capture("env")
+        environ = {}
+        for line in output.splitlines():
+            key, sep, value = line.partition("=")
+            if sep and key.isidentifier():
+                environ[key] = value
+        return environ
+
+    def interrupt(self, sig=signal.SIGINT):
+        """Signal the terminal's foreground job, as typing ^C would."""
+        if not self.busy:
+            return False
+        try:
+            os.killpg(os.tcgetpgrp(self.master), sig)
+        except OSError:
+            pass
+        return True
+
+    def send(self, text):
+        if not self.busy:
+            return False
+        os.write(self.master, text.encode())
+        return True
+
+    def close(self):
+        if self.pump is not None:
+            self.pump.cancel()
+        if self.alive:
+            # What a terminal does when its window closes
+            self._signal(signal.SIGHUP)
+        if self.master is not None:
+            os.close(self.master)
+            self.master = None
+
+    async def _exchange(self, line, sink):
+        self.done = asyncio.get_running_loop().create_future()
+        self.sink = sink
+        os.write(self.master, line.encode())
+        return await self.done
+
+    async def _pump(self):
+        # Reads the pty for the life of the shell, splitting output at sentinels
+        marker = self.marker
+        carry = b""
+        while True:
+            try:
+                chunk = await self.reader.read(READ_SIZE)
+            except OSError:
+                # EIO once the shell and everything on the pty is gone
+                chunk = b""
+            if not chunk:
+                break
+            data = carry + chunk
+            carry = b""
+            while data:
+                idx = data.find(marker)
+                if idx < 0:
+                    keep = _prefix_overlap(data, marker)
+                    self._emit(data[:len(data) - keep])
+                    carry = data[len(data) - keep:]
+                    break
+                end = data.find(b"\a", idx)
+                if end < 0:
+                    self._emit(data[:idx])
+                    carry = data[idx:]
+                    break
+                self._emit(data[:idx])
+                status, _, cwd = data[idx + len(marker):end].partition(b";")
+                self.cwd = os.fsdecode(cwd)
+                self._finish(int(status))
+                data = data[end + 1:]
+            if self.pending_size > self.high_water:
+                self.drained.clear()
+                await self.drained.wait()
+        self._finish(await self.process.wait())
+
+    def _emit(self, data):
+        if data and self.sink is not None:
+            self.sink(data)
+
+    def _finish(self, status):
+        # Anything after the sentinel is prompt noise
+        self.sink = None
+        if self.done is not None and not self.done.done():
+            self.done.set_result(status)
+
+def _prefix_overlap(data, marker):
+    # Length of the longest tail of data that could start a split marker
+    for size in range(min(len(marker) - 1, len(data)), 0, -1):
+        if marker.startswith(data[-size:]):
+            return size
+    return 0
@@ -1,27 +1,36 @@
 import asyncio
-from textual.widgets import Input, Static,  RichLog, MarkdownViewer
-from textual.containers import Vertical, Container, ScrollableContainer
+from collections import deque
+from contextlib import aclosing
+from textual.widgets import Input, Static
+from textual.containers import Vertical, Container
 from textual.message import Message
 from textual.reactive import reactive
-from rich.syntax import Syntax
-from rich.console import Console
-from rich.theme import Theme
 from rich.text import Text
-import subprocess
 import os
 from .suggestions import get_suggestions_async
 from .llm import LLM
+from .runner import ShellSession, command_runner
+from .jobs import JobManager, background_command, job_spec
+from .output import OutputLog, output_lexer
+from .http_pool import aclose_clients, close_clients
+from .trace import span, tracer
 from textual import log 
 
 from datetime import datetime
 import time
 
 from textual.app import App
-from textual.widgets import Header, Footer
 from textual.binding import Binding
 
 
-from .history import HistoryView, add_command_to_history, search_command_history
+# A second Ctrl+C within this many seconds, with nothing running, quits
+INTERRUPT_QUIT_WINDOW = 2.0
+# Streamed explanations re-render the advisor at most this many times a second
+ADVISOR_FPS = 15
+# Seconds between refreshes of the trace stats panel while it is shown
+TRACE_STATS_INTERVAL = 1.0
+# Seconds between refreshes of the jobs list while it is shown
+JOBS_INTERVAL = 1.0
 
 class ShellApp(App):
 
@@ -42,7 +51,11 @@ class ShellApp(App):
         Binding("ctrl+e", "explain_command", "Explain Command", priority=True),
         Binding("ctrl+r", "reverse_search", "Reverse Search", priority=True),
         Binding("ctrl+s", "select_suggestion", "Select Suggestion", priority=True),
-        # Binding("ctrl+c", "keyboard_interrupt", "Keyboard Interrupt", priority=True),
+        Binding("ctrl+c", "keyboard_interrupt", "Keyboard Interrupt", priority=True),
+        Binding("ctrl+o", "next_output", "Next Output", priority=True),
+        Binding("f9", "toggle_jobs", "Jobs"),
+        Binding("f12", "toggle_trace_stats", "Trace Stats"),
+        Binding("f11", "dump_trace", "Dump Trace"),
         Binding("escape", "multi_escape", priority=True),
         Binding("up", "multi_up", priority=True),
         Binding("down", "multi_down", priority=True),
@@ -71,6 +84,20 @@ class ShellApp(App):
     .scrollable {
         overflow-y: auto;
     }
+    #jobs {
+        dock: bottom;
+        height: auto;
+        max-height: 33%;
+        border: solid $accent;
+        display: none;
+    }
+    #trace-stats {
+        dock: bottom;
+        height: auto;
+        max-height: 50%;
+        border: solid $warning;
+        display: none;
+    }
     #maininput {
         border: solid $success;
         dock: bottom;
@@ -80,89 +107,173 @@ class ShellApp(App):
 
     def __init__(self):
         super().__init__()
-        self.console = Console(theme=Theme({"prompt": "cyan", "command": "green"}))
         self.suggestion_task = None
         self.llm = LLM()
+        self.runner = command_runner(self.append_output, self.current_directory)
+        self.interrupt_pressed = None
+        self.explanation = None
+        self.explanation_timer = None
+        self.trace_stats_timer = None
+        self.jobs = JobManager()
+        self.job_logs = {}
+        self.jobs_timer = None
 
     def compose(self):
         with Container(id="app-grid"):
-            with Vertical(id="left-pane"):
-                yield RichLog(highlight=True, markup=True, wrap=True, id="output", classes="box")
-                yield HistoryView(id="history-view", classes="scrollable")
-                yield Static(id="suggestions", classes="box")
-                yield Input(id="maininput", placeholder="Enter a command...", classes="box")
-            with Vertical(id="right-pane"):
-                yield MarkdownViewer("# Advice Widget", id="advisor", show_table_of_contents=False, classes="box")
+            # The history view and the advisor are mounted by warm_up
+            yield Vertical(
+                OutputLog(id="output", classes="box"),
+                Static(id="jobs"),
+                Static(id="suggestions", classes="box"),
+                Input(id="maininput", placeholder="Enter a command...", classes="box"),
+                id="left-pane",
+            )
+            yield Vertical(Static(id="trace-stats"), id="right-pane")
 
     def on_mount(self):
         self.input = self.query_one("#maininput")
         self.input.focus()
         self.output = self.query_one("#output")
         self.suggestions_widget = self.query_one("#suggestions")
+        self.trace_stats = self.query_one("#trace-stats")
+        self.jobs_widget = self.query_one("#jobs")
         self.output_container = self.output
-        self.advisor_viewer = self.query_one("#advisor")
-        self.advisor = self.advisor_viewer.document
-
-        self.history_view = self.query_one("#history-view")
-        self.history_view.display = False
+        # The log shown in command mode: #output or a background job's
+        self.visible_output = self.output
+        self.advisor_viewer = None
+        self.advisor = None
+        self.history_view = None
+        self.warmed_up = asyncio.Event()
 
         self.main_views = [
                 self.output,
-                self.history_view
         ]
         self.input_mode = "command"
         self.call_after_refresh(self.initial_layout)
 
+    async def on_unmount(self):
+        self.runner.close()
+        self.jobs.close()
+        close_clients()
+        await aclose_clients()
+        if self.history_view is not None:
+            from .history import history_writer, save_frecency
+            history_writer.close()
+            save_frecency()
+
     def initial_layout(self):
         log.info(f"Initial layout - Container: {self.output_container.size}, Output: {self.output.size}")
+        self.run_worker(self.warm_up, thread=True, exit_on_error=False)
+
+    def warm_up(self):
+        """Worker thread: load what the first paint could do without.
+
+        The history search pulls in numpy and the advisor the markdown
+        widgets; both are imported here, mounted, and then the history is
+        compacted and loaded. Compacting first means the load reads the
+        new file, which a later refresh then finds unchanged.
+        """
+        from textual.widgets import MarkdownViewer
+        from . import history
+        self.call_from_thread(self.mount_deferred, history.HistoryView, MarkdownViewer)
+        history.compact_history()
+        history.history_store.load()
+
+    async def mount_deferred(self, history_view_cls, viewer_cls):
+        history_view = history_view_cls(id="history-view", classes="scrollable")
+        history_view.display = False
+        advisor_viewer = viewer_cls("# Advice Widget", id="advisor", show_table_of_contents=False, classes="box")
+        await self.query_one("#left-pane").mount(history_view, before=self.suggestions_widget)
+        await self.query_one("#right-pane").mount(advisor_viewer, before=self.trace_stats)
+        self.history_view = history_view
+        self.main_views.append(history_view)
+        self.advisor_viewer = advisor_viewer
+        self.advisor = advisor_viewer.document
+        self.warmed_up.set()
 
     def prefix(self):
         # TODO: add cwd or whatever prefix from zsh here?
         return datetime.now().isoformat() + " % "
 
-    async def explain_command(self):
-        """Generate and display an explanation for the current command."""
+    def explain_command(self):
+        """Stream an explanation for the current command into the advisor.
+
+        Replaces any explanation still streaming.
+        """
         command = self.input.value
         if not command:
             return
 
         log.debug(f"explaining {command}")
-        self.advisor.update("Loading...")
+        # Each request streams into its own queue; one that was replaced
+        # writes into a queue nothing reads any more
+        chunks = self.explanation = deque()
+        self.advisor.update("# Command Explanation\n\n")
+        if self.explanation_timer is None:
+            self.explanation_timer = self.set_interval(1 / ADVISOR_FPS, self.render_explanation)
+        self.run_worker(
+            self._stream_explanation(command, self.current_directory, chunks),
+            group="explain", exclusive=True, exit_on_error=False)
+
+    async def _stream_explanation(self, command, current_dir, chunks):
+        # Queue chunks as they arrive, None once done; cancelling the
+        # worker closes the stream and its request
         try:
-            explanation = self.llm.prompt_call(
-                "explain_command",
-                command=command,
-                current_dir=self.current_directory
-            )
-
-            self.advisor.update(f"# Command Explanation\n\n{explanation}")
+            with span("explain.stream") as args:
+                args["chunks"] = 0
+                stream = self.llm.aprompt_stream("explain_command", command=command, current_dir=current_dir)
+                async with aclosing(stream):
+                    async for chunk in stream:
+                        chunks.append(chunk)
+                        args["chunks"] += 1
         except Exception as e:
             log.error(f"Error generating command explanation: {str(e)}")
-            self.advisor.update("# Error\n\nFailed to generate command explanation.")
-
-    def action_explain_command(self):
+            chunks.append(e)
+        finally:
+            chunks.append(None)
+
+    def render_explanation(self):
+        """Append what has streamed in since the last frame to the advisor."""
+        chunks = self.explanation
+        text = []
+        done = chunks is None
+        while chunks:
+            chunk = chunks.popleft()
+            if chunk is None:
+                done = True
+            elif isinstance(chunk, Exception):
+                self.advisor.update("# Error\n\nFailed to generate command explanation.")
+                text = []
+            else:
+                text.append(chunk)
+        if text:
+            with span("explain.render"):
+                self.advisor.append("".join(text))
+        if done:
+            self.explanation = None
+            self.explanation_timer.stop()
+            self.explanation_timer = None
+
+    async def action_explain_command(self):
         """Action to trigger command explanation."""
-        log.debug("setting up call later")
-        self.call_later(self.explain_command)
+        await self.warmed_up.wait()
+        self.explain_command()
 
     def highlight_input(self, text):
         """Apply syntax highlighting to the input text."""
-        return Text.from_markup(f"[prompt]$[/prompt] [command]{text}[/command]")
-
-    def highlight_output(self, text, lexer="bash"):
-        """Apply syntax highlighting to the output text."""
-        syntax = Syntax(text, lexer, theme="monokai", line_numbers=False)
-        with self.console.capture() as capture:
-            self.console.print(syntax)
-        return Text.from_ansi(capture.get())
+        return Text.from_markup(f"[cyan]$[/cyan] [green]{text}[/green]")
 
     async def update_suggestions(self, value):
         """Debounced method to update suggestions."""
-        await asyncio.sleep(0.5)  # Reduced debounce delay
-        suggestions = await get_suggestions_async(value, self.current_directory, self.command_history)
-        self.suggestions = suggestions
-        self.display_suggestions(suggestions)
-        self.post_message(self.SuggestionsUpdated(suggestions))
+        # From the keystroke to the suggestions on screen
+        with span("suggestions.update"):
+            with span("suggestions.debounce"):
+                await asyncio.sleep(0.5)  # Reduced debounce delay
+            suggestions = await get_suggestions_async(value, self.current_directory, self.command_history)
+            with span("suggestions.render"):
+                self.suggestions = suggestions
+                self.display_suggestions(suggestions)
+                self.post_message(self.SuggestionsUpdated(suggestions))
 
     def display_suggestions(self, suggestions):
         """Display suggestions below the input."""
@@ -173,18 +284,27 @@ class ShellApp(App):
         for v in self.main_views:
             v.display = False
         if self.input_mode == "command":
-            self.output.display = True
+            self.visible_output.display = True
         elif self.input_mode == "history":
             self.history_view.display = True
 
-    def keyboard_interrupt(self):
-        # if there's a running process, transmit sigterm
-        # if the user pressed recently, issue sigterm/quit
+    def action_keyboard_interrupt(self):
+        # if there's a running process, interrupt it
+        # if the user pressed recently, quit
         # otherwise set the flag to quit again
-        if self.interrupt_pressed is not None:
-            self.app.quit()
+        job = self.visible_job()
+        if job is not None and job.status == "running":
+            job.runner.interrupt()
+            self.append_output("^C", self.visible_output)
+            return
+        if self.runner.interrupt():
+            self.append_output("^C")
+            return
+        now = time.time()
+        if self.interrupt_pressed is not None and now - self.interrupt_pressed < INTERRUPT_QUIT_WINDOW:
+            self.exit()
             return
-        self.interrupt_pressed = time.time()
+        self.interrupt_pressed = now
         self.suggestions_widget.update("press Ctrl+C again to quit")
 
     def action_multi_escape(self):
@@ -208,22 +328,144 @@ class ShellApp(App):
         elif self.input_mode == "history":
             self.history_view.next_command()
 
+    def visible_job(self):
+        """The background job whose output is shown, if any."""
+        for job_id, output in self.job_logs.items():
+            if output is self.visible_output:
+                return self.jobs.get(job_id)
+        return None
+
+    def show_output(self, output):
+        """Show an output log (#output or a job's) in command mode."""
+        self.visible_output = output
+        self.input_mode = "command"
+        self.update_main_view()
+        if self.jobs_widget.display:
+            self.show_jobs()
+
+    def action_next_output(self):
+        logs = [self.output, *self.job_logs.values()]
+        self.show_output(logs[(logs.index(self.visible_output) + 1) % len(logs)])
+
+    def action_toggle_jobs(self):
+        self.jobs_widget.display = not self.jobs_widget.display
+        if self.jobs_widget.display:
+            self.show_jobs()
+            self.jobs_timer = self.set_interval(JOBS_INTERVAL, self.show_jobs)
+        elif self.jobs_timer is not None:
+            self.jobs_timer.stop()
+            self.jobs_timer = None
+
+    def show_jobs(self):
+        """Fill the jobs list with each job's status, runtime and exit status."""
+        from rich.table import Table
+        table = Table("", "job", "status", "runtime", "exit", "command", box=None, expand=True)
+        shown = self.visible_job()
+        table.add_row(">" if shown is None else "", "", "", "", "", "(shell)")
+        for job in self.jobs:
+            exit_status = "" if job.returncode is None else str(job.returncode)
+            table.add_row(">" if job is shown else "", f"%{job.id}", job.status, f"{job.runtime:.1f}s", exit_status, job.command)
+        self.jobs_widget.update(table)
+
+    async def start_job(self, command):
+        """Run command as a background job with its own output log."""
+        # What the shell exported so far, so a job sees the same variables as the next foreground command
+        env = await self.runner.environ() if isinstance(self.runner, ShellSession) else None
+        job = self.jobs.add(command, self.current_directory, lambda content: self.append_output(content, output), env)
+        output = self.job_logs[job.id] = OutputLog(id=f"job-{job.id}", classes="box")
+        output.display = False
+        await self.query_one("#left-pane").mount(output, before=self.jobs_widget)
+        self.main_views.append(output)
+        output.write(self.prefix() + command)
+        self.append_output(Text(f"[{job.id}] {command}", style="dim"))
+        self.run_worker(self.run_job(job), group="jobs", exit_on_error=False)
+
+    async def run_job(self, job):
+        output = self.job_logs[job.id]
+        try:
+            returncode = await self.jobs.run(job)
+        except Exception as e:
+            self.append_output(Text(f"Error: {e}", style="red"), output)
+            job.status = "failed"
+            returncode = None
+        if returncode:
+            self.append_output(Text(f"[exit {returncode}]", style="red"), output)
+        self.append_output(Text(f"[{job.id}] {job.status}  {job.command}", style="dim"))
+        if self.jobs_widget.display:
+            self.show_jobs()
+
+    def job_command(self, command):
+        """Handle the job control builtins; False for anything else.
+
+        "jobs" toggles the jobs list, "%N" shows job N's output ("%0" the
+        shell's) and "kill %N" terminates job N.
+        """
+        words = command.split()
+        if words == ["jobs"]:
+            self.action_toggle_jobs()
+            return True
+        if len(words) == 1 and job_spec(words[0]) is not None:
+            output = self.output if job_spec(words[0]) == 0 else self.job_logs.get(job_spec(words[0]))
+            if output is None:
+                self.suggestions_widget.update(f"no such job: {words[0]}")
+            else:
+                self.show_output(output)
+            return True
+        if len(words) == 2 and words[0] == "kill" and job_spec(words[1]) is not None:
+            if not self.jobs.kill(job_spec(words[1])):
+                self.suggestions_widget.update(f"no such job: {words[1]}")
+            return True
+        return False
+
+    def action_toggle_trace_stats(self):
+        self.trace_stats.display = not self.trace_stats.display
+        if self.trace_stats.display:
+            self.show_trace_stats()
+            self.trace_stats_timer = self.set_interval(TRACE_STATS_INTERVAL, self.show_trace_stats)
+        elif self.trace_stats_timer is not None:
+            self.trace_stats_timer.stop()
+            self.trace_stats_timer = None
+
+    def show_trace_stats(self):
+        """Fill the trace stats panel with per-span latencies from the trace buffer."""
+        from rich.table import Table
+        table = Table("span", "n", "p50 ms", "p99 ms", "max ms", "last ms", box=None, expand=True)
+        for name, stats in sorted(tracer.stats().items()):
+            errors = f" ({stats['errors']} err)" if stats["errors"] else ""
+            table.add_row(name, f"{stats['count']}{errors}", f"{stats['p50_ms']:.1f}", f"{stats['p99_ms']:.1f}",
+                          f"{stats['max_ms']:.1f}", f"{stats['last_ms']:.1f}")
+        self.trace_stats.update(table)
+
+    def action_dump_trace(self):
+        try:
+            path = tracer.dump()
+        except OSError as e:
+            self.suggestions_widget.update(f"could not write trace: {e}")
+            return
+        self.suggestions_widget.update(f"trace written to {path}")
+
     def action_select_suggestion(self):
         selected_suggestion = self.suggestions[self.suggestions_widget.highlighted_line]
         self.input.value = selected_suggestion
 
-    def action_reverse_search(self):
+    async def action_reverse_search(self):
+        await self.warmed_up.wait()
+        self.history_view.search("", refresh=True)
         self.input.value = ""
         self.input.placeholder = "Search history (press Enter to select, Esc to cancel)"
         self.input.focus()
         self.input_mode = "history"
         self.update_main_view()
 
-    def append_output(self, new_content):
+    def append_output(self, new_content, target=None):
+        target = target or self.output
+        if isinstance(new_content, str) and "\x1b" in new_content:
+            # Commands on the pty may still colour their output
+            new_content = Text.from_ansi(new_content)
         if isinstance(new_content, Text):
-            self.output.write(new_content)
+            target.write(new_content)
         elif isinstance(new_content, str):
-            self.output.write(new_content)
+            target.write(new_content)
         else:
             log.warning(f"Unexpected content type: {type(new_content)}")
             return
@@ -242,29 +484,54 @@ class ShellApp(App):
             self.input_mode = "command"
             self.update_main_view()
             return
-        
+
+        if self.runner.send(command + "\n"):
+            # Input for the running command, not a new one
+            self.output.write(command)
+            self.input.value = ""
+            return
+
+        if self.job_command(command):
+            self.input.value = ""
+            return
+
+        from .history import add_command_to_history, history_store
+        add_command_to_history(command)
+        history_store.record_cwd(command, self.current_directory)
+        self.input.value = ""
+        background = background_command(command)
+        if background is not None:
+            self.run_worker(self.start_job(background), exit_on_error=False)
+            return
+
         # highlighted_input = self.highlight_input(command)
         # self.append_output(highlighted_input)
         self.output.write(self.prefix()+command)
-        add_command_to_history(command)
         # self.output.refresh()
-        
+        if self.visible_output is not self.output:
+            self.show_output(self.output)
+        self.run_worker(self.run_command(command), group="commands", exit_on_error=False)
+
+    async def run_command(self, command):
+        """Run command, streaming its output into #output as it arrives."""
         try:
-            result = subprocess.run(command, shell=True, capture_output=True, text=True, cwd=self.current_directory)
-            output = result.stdout if result.returncode == 0 else result.stderr
-            highlighted_output = output # self.highlight_output(output)
-            log.debug(f"Highlighted output type: {type(highlighted_output)}")
-            self.append_output(highlighted_output)
+            self.output.set_lexer(output_lexer(command))
+            try:
+                with span("command.run") as args:
+                    returncode = args["returncode"] = await self.runner.run(command, cwd=self.current_directory)
+            finally:
+                self.output.set_lexer(None)
+            if returncode != 0:
+                self.append_output(Text(f"[exit {returncode}]", style="red"))
 
             # Update command history
             self.command_history.append(command)
             if len(self.command_history) > 500:  # Keep last 50o commands
                 self.command_history.pop(0)
 
-            # Update current directory if the command was 'cd'
-            if command.startswith('cd '):
-                new_dir = command[3:].strip()
-                self.current_directory = os.path.abspath(os.path.join(self.current_directory, new_dir))
+            # Follow the shell's working directory
+            if self.runner.cwd != self.current_directory:
+                self.current_directory = self.runner.cwd
                 log.info(f"Changed directory to: {self.current_directory}")
 
         except Exception as e:
@@ -272,22 +539,22 @@ class ShellApp(App):
             self.append_output(error_output)
             log.error(f"Error executing command: {str(e)}")
 
-        self.input.value = ""
-        
+
     def on_input_changed(self, message):
         """Handle immediate input updates."""
         current_input = message.value
 
-        if self.input_mode == "history":
-            # search history instead of / in addition to LLM stuff
-            self.history_view.update(current_input)
-        else:
-            # Cancel the previous suggestion task if it exists
-            if self.suggestion_task:
-                self.suggestion_task.cancel()
-
-            # Start a new suggestion task
-            self.suggestion_task = asyncio.create_task(self.update_suggestions(current_input))
+        with span("input.changed", mode=self.input_mode):
+            if self.input_mode == "history":
+                # search history instead of / in addition to LLM stuff
+                self.history_view.search(current_input)
+            else:
+                # Cancel the previous suggestion task if it exists
+                if self.suggestion_task:
+                    self.suggestion_task.cancel()
+
+                # Start a new suggestion task
+                self.suggestion_task = asyncio.create_task(self.update_suggestions(current_input))
 
 
 
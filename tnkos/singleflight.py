@@ -0,0 +1,141 @@
+"""Single-flight request coalescing.
+
+Concurrent callers asking for the same key share one upstream request:
+the first starts it, later ones wait for it and get the same result
+(or exception). Once it finishes the key is free again; anything that
+should outlive the request, like a cache entry, is the caller's job.
+"""
+import asyncio
+import threading
+from contextlib import aclosing
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class _Broadcast:
+    """One upstream async stream read once and replayed to every reader.
+
+    Readers that join late get the chunks so far, then the rest as they
+    arrive. When the last reader leaves before the end, the upstream is
+    cancelled and closed.
+    """
+
+    def __init__(self, stream, on_done):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.readers = 0
+        self.changed = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._pump(stream))
+        self.task.add_done_callback(lambda _: on_done(self))
+
+    async def _pump(self, stream):
+        try:
+            async with aclosing(stream):
+                async for chunk in stream:
+                    self.chunks.append(chunk)
+                    self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._notify()
+
+    def _notify(self):
+        # Wake whoever waits on the current event; later waits use a new one
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def read(self):
+        self.readers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self.changed.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0 and not self.task.done():
+                self.task.cancel()
+
+class SingleFlight:
+    """Coalesces identical in-flight calls and streams, keyed by the caller.
+
+    call() is for blocking calls from any thread, acall() for coroutines
+    and astream() for async generators; each has its own keyspace. Async
+    requests belong to the event loop they were started on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.tasks = {}
+        self.streams = {}
+
+    def call(self, key, fn):
+        """fn(), or the result of the same call already running in another thread."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    async def acall(self, key, factory):
+        """await factory(), or join the same request already in flight.
+
+        The request runs as its own task: a caller that is cancelled stops
+        waiting without cancelling it for the others, and it is cancelled
+        only once nobody waits for it.
+        """
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        entry = self.tasks.get(flight_key)
+        if entry is None or entry[0].done():
+            entry = self.tasks[flight_key] = [loop.create_task(factory()), 0]
+            entry[0].add_done_callback(lambda _, entry=entry: self._forget(self.tasks, flight_key, entry))
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+    def astream(self, key, factory):
+        """An async generator over factory()'s chunks, shared with concurrent readers of key."""
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        broadcast = self.streams.get(flight_key)
+        if broadcast is None:
+            broadcast = self.streams[flight_key] = _Broadcast(
+                factory(), lambda broadcast: self._forget(self.streams, flight_key, broadcast))
+        return broadcast.read()
+
+    @staticmethod
+    def _forget(flights, key, entry):
+        if flights.get(key) is entry:
+            del flights[key]
@@ -0,0 +1,182 @@
+"""Incremental server-sent events decoding for streamed LLM responses.
+
+SSEDecoder turns the raw bytes of a text/event-stream response, in
+whatever chunks they arrive, into events; openai_deltas() and
+anthropic_deltas() turn each backend's events into typed Deltas; and
+StreamMeter times a stream's first token and its tokens per second.
+"""
+import json
+import re
+import time
+from collections import namedtuple
+
+from .trace import tracer
+
+SSEEvent = namedtuple("SSEEvent", "event data id")
+
+# type is "text" (value: the text), "stop" (the finish reason), "usage"
+# (output tokens so far), "error" (the message) or "done" (None)
+Delta = namedtuple("Delta", "type value")
+
+LINE_END = re.compile(rb"\r\n|\r|\n")
+
+class StreamError(RuntimeError):
+    """An error reported by the server in the middle of a stream."""
+
+class SSEDecoder:
+    """Decodes an event stream fed to it a chunk of bytes at a time.
+
+    Bytes are appended to one buffer, which is searched for line ends
+    where it is; only each line is copied out to be parsed, and the
+    consumed part is dropped once per chunk, not once per line. Lines may
+    end in CRLF, LF or a lone CR, split across chunks or not.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.event = ""
+        self.data = []
+        self.last_id = None
+
+    def feed(self, chunk):
+        """The events completed by chunk, in order."""
+        buffer = self.buffer
+        buffer += chunk
+        events = []
+        pos = 0
+        while True:
+            match = LINE_END.search(buffer, pos)
+            if match is None:
+                break
+            # A CR ending the buffer may be the first half of a CRLF
+            if match.group() == b"\r" and match.end() == len(buffer):
+                break
+            event = self._line(buffer[pos:match.start()])
+            if event is not None:
+                events.append(event)
+            pos = match.end()
+        if pos:
+            del buffer[:pos]
+        return events
+
+    def flush(self):
+        """The event left pending at the end of the stream, if any."""
+        if self.buffer:
+            event = self._line(bytes(self.buffer).rstrip(b"\r"))
+            self.buffer.clear()
+            if event is not None:
+                return event
+        return self._dispatch()
+
+    def _line(self, line):
+        if not line:
+            return self._dispatch()
+        if line[0] == 0x3A:  # ":" starts a comment, such as a keep-alive
+            return None
+        field, colon, value = line.partition(b":")
+        if colon and value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self.data.append(value.decode("utf-8", "replace"))
+        elif field == b"event":
+            self.event = value.decode("utf-8", "replace")
+        elif field == b"id" and b"\0" not in value:
+            self.last_id = value.decode("utf-8", "replace")
+        return None
+
+    def _dispatch(self):
+        if not self.data:
+            self.event = ""
+            return None
+        event = SSEEvent(self.event or "message", "\n".join(self.data), self.last_id)
+        self.event = ""
+        self.data = []
+        return event
+
+def openai_deltas(event):
+    """Deltas in an OpenAI-compatible chat completion chunk."""
+    if event.data == "[DONE]":
+        return [Delta("done", None)]
+    chunk = json.loads(event.data)
+    if "error" in chunk:
+        error = chunk["error"]
+        return [Delta("error", error.get("message", str(error)) if isinstance(error, dict) else str(error))]
+    deltas = []
+    for choice in chunk.get("choices") or ():
+        # Only the first choice is streamed when several are asked for
+        if choice.get("index", 0) != 0:
+            continue
+        content = (choice.get("delta") or {}).get("content")
+        if content:
+            deltas.append(Delta("text", content))
+        if choice.get("finish_reason") is not None:
+            deltas.append(Delta("stop", choice["finish_reason"]))
+    usage = chunk.get("usage")
+    if usage and usage.get("completion_tokens") is not None:
+        deltas.append(Delta("usage", usage["completion_tokens"]))
+    return deltas
+
+def anthropic_deltas(event):
+    """Deltas in an Anthropic Messages API stream event."""
+    if event.event == "ping":
+        return []
+    data = json.loads(event.data)
+    kind = data.get("type", event.event)
+    if kind == "content_block_delta":
+        delta = data.get("delta", {})
+        if delta.get("type", "text_delta") == "text_delta" and delta.get("text"):
+            return [Delta("text", delta["text"])]
+    elif kind == "message_delta":
+        deltas = []
+        if data.get("delta", {}).get("stop_reason") is not None:
+            deltas.append(Delta("stop", data["delta"]["stop_reason"]))
+        if data.get("usage", {}).get("output_tokens") is not None:
+            deltas.append(Delta("usage", data["usage"]["output_tokens"]))
+        return deltas
+    elif kind == "message_stop":
+        return [Delta("done", None)]
+    elif kind == "error":
+        return [Delta("error", data.get("error", {}).get("message", event.data))]
+    return []
+
+DELTAS = {"openai": openai_deltas, "anthropic": anthropic_deltas}
+
+class StreamMeter:
+    """Times a stream's first token and its rate into a span's args.
+
+    The time to the first text is also recorded as an "llm.ttft" span, so
+    it shows up in the trace stats next to llm.stream. Tokens are the
+    server's count when it reports usage, else the number of text deltas.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.start = time.perf_counter_ns()
+        self.first = None
+        self.deltas = 0
+        self.tokens = None
+        self.finish_reason = None
+
+    def add(self, delta):
+        if delta.type == "text":
+            if self.first is None:
+                self.first = time.perf_counter_ns()
+                self.args["ttft_ms"] = (self.first - self.start) / 1e6
+                if tracer.enabled:
+                    tracer.record("llm.ttft", self.start, self.first - self.start,
+                                  {"api": self.args.get("api"), "model": self.args.get("model")})
+            self.deltas += 1
+        elif delta.type == "usage":
+            self.tokens = delta.value
+        elif delta.type == "stop":
+            self.finish_reason = delta.value
+
+    def finish(self):
+        end = time.perf_counter_ns()
+        tokens = self.tokens if self.tokens is not None else self.deltas
+        self.args["tokens"] = tokens
+        if self.finish_reason is not None:
+            self.args["finish_reason"] = self.finish_reason
+        # The rate while generating: from the first token on, not counting the wait for it
+        if self.first is not None and tokens > 1 and end > self.first:
+            self.args["tokens_per_s"] = (tokens - 1) / ((end - self.first) / 1e9)
@@ -0,0 +1,64 @@
+"""Startup profiling for tnkos.
+
+profile_startup() starts the app headless in a child Python run with
+-X importtime, stops it at its first paint, and reports the slowest
+imports on the way there along with how long the paint took.
+"""
+import os
+import subprocess
+import sys
+import time
+
+# Written to stderr by the child between its importtime lines
+PAINTED = "tnkos-startup:"
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+def first_paint():
+    """Child side: run ShellApp headless until its first paint, then exit."""
+    start = time.perf_counter()
+    from .shell_widget import ShellApp
+    imported = time.perf_counter()
+
+    async def painted(pilot):
+        print(f"{PAINTED} {imported - start:.6f} {time.perf_counter() - start:.6f}", file=sys.stderr, flush=True)
+        pilot.app.exit()
+
+    ShellApp().run(headless=True, auto_pilot=painted)
+
+def parse_importtime(lines):
+    """(cumulative_us, self_us, module) for each "import time:" line."""
+    imports = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        imports.append((int(fields[1]), int(fields[0]), fields[2].rstrip()))
+    return imports
+
+def profile_startup(top=30, file=sys.stdout):
+    """Report import times per module and time to first paint; the process's exit status."""
+    start = time.perf_counter()
+    child = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "from tnkos.startup import first_paint; first_paint()"],
+        cwd=ROOT, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    lines = child.stderr.splitlines()
+    marks = [line for line in lines if line.startswith(PAINTED)]
+    if child.returncode or not marks:
+        print("\n".join(line for line in lines if not line.startswith("import time:")), file=sys.stderr)
+        return child.returncode or 1
+
+    # Only what was imported before the first paint held it up
+    painted_at = lines.index(marks[0])
+    imports = parse_importtime(lines[:painted_at])
+    imported, paint = (float(value) for value in marks[0][len(PAINTED):].split())
+    print(f"{'cumulative':>12} {'self':>10}  module", file=file)
+    for cumulative, own, module in sorted(imports, reverse=True)[:top]:
+        print(f"{cumulative / 1000:9.1f} ms {own / 1000:7.1f} ms  {module}", file=file)
+    print(file=file)
+    print(f"{len(imports)} modules, {sum(own for _, own, _ in imports) / 1000:.1f} ms importing", file=file)
+    print(f"ShellApp imported in {imported * 1000:.1f} ms, first paint at {paint * 1000:.1f} ms", file=file)
+    print(f"process wall time {wall * 1000:.1f} ms (interpreter start to exit)", file=file)
+    return 0
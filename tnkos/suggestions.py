@@ -1,31 +1,45 @@
 # tnkos/suggestions.py
 
-import asyncio
+from collections import OrderedDict
 from functools import lru_cache
 from .llm import LLM
-import os
+from .trace import span
 
-llm = LLM()
+@lru_cache(maxsize=None)
+def get_llm():
+    # Made on first use rather than at import, which is on the startup path
+    return LLM()
 
-@lru_cache(maxsize=100)
-def get_cached_suggestions(input_prefix, current_dir, history):
+SUGGESTION_CACHE_SIZE = 100
+# (input_prefix, current_dir, history) -> LLM reply, least recently used first
+suggestion_cache = OrderedDict()
+
+async def get_cached_suggestions(input_prefix, current_dir, history):
     # This function will cache results based on the input parameters
-    return llm.prompt_call("shell_suggestions", 
-                           input_prefix=input_prefix, 
-                           current_dir=current_dir, 
-                           history=history)
+    key = (input_prefix, current_dir, history)
+    with span("suggestions.llm") as args:
+        args["cached"] = key in suggestion_cache
+        if key in suggestion_cache:
+            suggestion_cache.move_to_end(key)
+            return suggestion_cache[key]
+        suggestions_str = await get_llm().aprompt_call("shell_suggestions", 
+                               input_prefix=input_prefix, 
+                               current_dir=current_dir, 
+                               history=history)
+    suggestion_cache[key] = suggestions_str
+    if len(suggestion_cache) > SUGGESTION_CACHE_SIZE:
+        suggestion_cache.popitem(last=False)
+    return suggestions_str
 
 async def get_suggestions_async(current_input, current_dir, history):
-    # Simulate an asynchronous operation
-    await asyncio.sleep(0.1)
-    
     # Convert history list to a string
     history_str = "\n".join(history[-5:])  # Use last 5 commands for context
     
     # Get suggestions from LLM (using cache)
-    suggestions_str = get_cached_suggestions(current_input[:10], current_dir, history_str)
+    suggestions_str = await get_cached_suggestions(current_input[:10], current_dir, history_str)
     
     # Parse suggestions string into a list
-    suggestions = [s.strip() for s in suggestions_str.split(',') if s.strip()]
+    with span("suggestions.parse"):
+        suggestions = [s.strip() for s in suggestions_str.split(',') if s.strip()]
     
     return suggestions[:3]  # Limit to 3 suggestions
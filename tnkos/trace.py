@@ -0,0 +1,141 @@
+"""Lightweight span tracing.
+
+A span is a named, timed stretch of work:
+
+    with span("history.search", query_len=len(query)):
+        ...
+
+    @traced("llm.call")
+    def llm_call(...):
+        ...
+
+Finished spans go into a ring buffer holding the last RING_SIZE of them;
+stats() summarizes the buffer per span name and dump() writes it as a
+Chrome trace (chrome://tracing, ui.perfetto.dev). Recording a span is a
+couple of clock reads and a deque append, safe from any thread.
+
+Span args end up in the buffer and in dumps, so they hold sizes, counts
+and ids, never user text such as a query or a command line.
+"""
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+RING_SIZE = 20_000
+TRACE_FILE = os.path.expanduser(os.getenv("TNKOS_TRACE_FILE", "~/.tnkos_trace.json"))
+
+# start and duration in ns, from perf_counter_ns
+Span = namedtuple("Span", "name start duration thread args")
+
+class Tracer:
+    """Records finished spans into a bounded ring buffer."""
+
+    def __init__(self, size=RING_SIZE):
+        self.spans = deque(maxlen=size)
+        self.enabled = os.getenv("TNKOS_TRACE", "1") != "0"
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield args
+        except BaseException as e:
+            # Cancelled debounces are as telling as finished ones
+            args["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(name, start, time.perf_counter_ns() - start, args)
+
+    def record(self, name, start, duration, args=None):
+        self.spans.append(Span(name, start, duration, threading.get_ident(), args or {}))
+
+    def clear(self):
+        self.spans.clear()
+
+    def stats(self):
+        """{name: {count, errors, mean_ms, p50_ms, p99_ms, max_ms, last_ms}} over the buffer."""
+        durations = {}
+        errors = {}
+        for span in list(self.spans):
+            durations.setdefault(span.name, []).append(span.duration)
+            if "error" in span.args:
+                errors[span.name] = errors.get(span.name, 0) + 1
+        stats = {}
+        for name, values in durations.items():
+            last = values[-1]
+            values.sort()
+            stats[name] = {
+                "count": len(values),
+                "errors": errors.get(name, 0),
+                "mean_ms": sum(values) / len(values) / 1e6,
+                "p50_ms": values[(len(values) - 1) // 2] / 1e6,
+                "p99_ms": values[min(len(values) - 1, round(0.99 * (len(values) - 1)))] / 1e6,
+                "max_ms": values[-1] / 1e6,
+                "last_ms": last / 1e6,
+            }
+        return stats
+
+    def chrome_trace(self):
+        """The buffer in Chrome's Trace Event format, as a dict."""
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for span in list(self.spans):
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            events.append({
+                "name": span.name,
+                "cat": span.name.partition(".")[0],
+                "ph": "X",
+                "ts": span.start / 1000,
+                "dur": span.duration / 1000,
+                "pid": pid,
+                "tid": tid,
+                "args": {key: _jsonable(value) for key, value in span.args.items()},
+            })
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, tid in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                           "args": {"name": names.get(ident, f"thread {ident}")}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path=TRACE_FILE):
+        """Write the buffer to path as a Chrome trace; returns the path."""
+        with open(path, "w") as file:
+            json.dump(self.chrome_trace(), file)
+        return path
+
+def _jsonable(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
+
+tracer = Tracer()
+
+def span(name, **args):
+    """Context manager timing its body as a span called name."""
+    return tracer.span(name, **args)
+
+def traced(name=None):
+    """Decorator recording each call of a function or coroutine function as a span."""
+    def decorate(func):
+        span_name = name or func.__qualname__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with tracer.span(span_name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with tracer.span(span_name):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -12,6 +12,7 @@ from typing import Optional, List
 
 from bs4 import BeautifulSoup
 
+from tnkos.http_pool import aclose_clients, get_async_client
 from tnkos.llm import LLM
 from tnktools.grab_tweet import grab_tweet, describe_tweet_with_pixtral
 from tnktools.llmjson import parse_llm_json
@@ -47,12 +48,15 @@ def init_db():
             )
         """)
 
-def add_note(content: str, url: Optional[str] = None):
+async def add_note(content: str, url: Optional[str] = None):
     llm = LLM()
-    tags = llm.prompt_call("generate_tags", content=content)
+    # The two questions are independent, so ask them at the same time
+    tags, should_have_due_date = await asyncio.gather(
+        llm.aprompt_call("generate_tags", content=content),
+        llm.aprompt_call("should_have_due_date", content=content),
+    )
     tags = parse_llm_json(tags)  # Assuming the LLM returns a JSON string of tags
     
-    should_have_due_date = llm.prompt_call("should_have_due_date", content=content)
     due_at = datetime.now() if should_have_due_date.lower() == "true" else None
     
     with sqlite3.connect(DB_PATH) as conn:
@@ -102,9 +106,9 @@ async def handle_twitter_link(url: str) -> str:
         return f"Error processing tweet: {str(e)}"
 
 
-def fetch_and_distill_url(url: str) -> str:
+async def fetch_and_distill_url(url: str) -> str:
     try:
-        response = httpx.get(url)
+        response = await get_async_client(url).get(url)
         response.raise_for_status()  # Raise an exception for bad status codes
         
         # Parse the HTML content
@@ -128,7 +132,7 @@ def fetch_and_distill_url(url: str) -> str:
             text_content = text_content[:max_chars] + "..."
         
         llm = LLM()
-        distilled_content = llm.prompt_call("distill_content", content=text_content)
+        distilled_content = await llm.aprompt_call("distill_content", content=text_content)
         return distilled_content
     except httpx.HTTPStatusError as e:
         return f"HTTP Error: {e.response.status_code} - {e.response.text}"
@@ -156,16 +160,16 @@ async def main():
                     print("twitter")
                     content = await handle_twitter_link(args.url)
                 else:
-                    content = fetch_and_distill_url(args.url)
-                add_note(content, args.url)
+                    content = await fetch_and_distill_url(args.url)
+                await add_note(content, args.url)
             elif args.content:
-                add_note(args.content)
+                await add_note(args.content)
             else:
                 # Read from stdin if no content is provided
                 print("Enter your note (press Ctrl+D when finished):")
                 content = sys.stdin.read().strip()
                 if content:
-                    add_note(content)
+                    await add_note(content)
                 else:
                     print("Error: No content provided.")
 
@@ -183,6 +187,8 @@ async def main():
         print(f"An error occurred with the database: {e}")
     except httpx.RequestError as e:
         print(f"An error occurred while fetching the URL: {e}")
+    finally:
+        await aclose_clients()
 
 if __name__ == "__main__":
     asyncio.run(main=main())